@@ -0,0 +1,119 @@
+"""Synthetic `docker-printer` project generator for benchmarks
+
+Usage: python -m benchmarks.generate OUTPUT_DIR [--modules 100] [--targets 50] ...
+"""
+
+import argparse
+import random
+import textwrap
+from pathlib import Path
+
+import yaml
+
+TEMPLATE = textwrap.dedent(
+    """
+    {% extends "stage.Dockerfile.jinja2" %}
+
+    {% block instructions -%}
+    {% for step in steps -%}
+    RUN echo "{{ name }} step {{ loop.index }}: {{ step|upper }}" {{ flags|join(" ") }}
+    {% endfor %}
+    {%- endblock %}
+    """
+).lstrip()
+
+
+def generate_project(
+    root: Path,
+    modules: int = 100,
+    targets: int = 50,
+    fanout: int = 2,
+    extends_depth: int = 2,
+    template_size: int = 10,
+    seed: int = 0,
+) -> Path:
+    """Writes a project under `root` and returns `root`
+
+    - `modules`: number of module files. The first is the only one with a base image.
+    - `targets`: number of targets, each using two randomly chosen modules.
+    - `fanout`: number of `depends_on` entries per module, chosen among earlier modules.
+    - `extends_depth`: length of the `extends` chains that targets are grouped into.
+    - `template_size`: number of rendered instructions per module chunk.
+    """
+    rng = random.Random(seed)
+    config = root / "docker-printer"
+    (config / "modules").mkdir(parents=True, exist_ok=True)
+    (config / "templates").mkdir(parents=True, exist_ok=True)
+    (config / "templates" / "bench.Dockerfile.jinja2").write_text(TEMPLATE)
+
+    for i in range(modules):
+        module = dict(
+            name=f"mod-{i:05d}",
+            # Earlier modules come earlier in the chain, so dependencies precede dependents
+            priority=modules - i,
+            template=dict(
+                file="bench.Dockerfile.jinja2",
+                variables=dict(
+                    steps=[f"step {j} of module {i}" for j in range(template_size)],
+                    flags=["--quiet", f"--id={i}"],
+                    env={f"MOD_{i}": str(i)},
+                ),
+            ),
+            image_args={f"ARG_{i % 10}": str(i)},
+        )
+        if i == 0:
+            module["template"]["variables"]["base"] = "python:${ARG_0}-slim"
+        else:
+            module["depends_on"] = sorted(
+                {f"mod-{rng.randrange(i):05d}" for _ in range(fanout)}
+            )
+        (config / "modules" / f"mod-{i:05d}.yml").write_text(yaml.safe_dump(module))
+
+    target_list = []
+    for i in range(targets):
+        target = dict(
+            name=f"target-{i:05d}",
+            modules=sorted({f"mod-{rng.randrange(modules):05d}" for _ in range(2)}),
+            tags=["even" if i % 2 == 0 else "odd"],
+        )
+        if extends_depth and i % (extends_depth + 1):
+            target["extends"] = [f"target-{i - 1:05d}"]
+        target_list.append(target)
+    (config / "targets.yml").write_text(yaml.safe_dump(target_list))
+
+    builds = [
+        dict(
+            name="default",
+            image="bench",
+            build_args={"cache-from": ["type=registry,ref=bench:${TARGET}"]},
+        ),
+        dict(name="even", image=["bench", "mirror/bench"], limit_tags=["even"]),
+    ]
+    (config / "builds.yml").write_text(yaml.safe_dump(builds))
+    return root
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--modules", type=int, default=100)
+    parser.add_argument("--targets", type=int, default=50)
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--extends-depth", type=int, default=2)
+    parser.add_argument("--template-size", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_project(
+        args.output,
+        modules=args.modules,
+        targets=args.targets,
+        fanout=args.fanout,
+        extends_depth=args.extends_depth,
+        template_size=args.template_size,
+        seed=args.seed,
+    )
+    print(f"Generated project in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Checks that the CLI starts quickly for commands that don't synthesize anything
+
+Runs each command in a fresh interpreter under `python -X importtime`, and fails if
+it imports a module that only synthesis needs (pydantic, jinja2, yaml, ...), or if
+its imports take longer than its budget (best of `--repeat` runs).
+
+Usage:
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --budget-ms 150 --verbose
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+# Runs the CLI under its installed name, which shell completion keys on
+_AS_CLI = (
+    "import sys; sys.argv[0] = 'docker-printer'; "
+    "from docker_printer.__main__ import main; main()"
+)
+_COMPLETE = dict(
+    _DOCKER_PRINTER_COMPLETE="complete_bash",
+    COMP_WORDS="docker-printer sy",
+    COMP_CWORD="1",
+)
+
+# Arguments to python, extra environment variables, and import budget in milliseconds
+COMMANDS = {
+    "import cli": (["-c", "import docker_printer.cli"], None, 1.0),
+    "--version": (["-m", "docker_printer", "--version"], None, 1.0),
+    "completion": (["-c", _AS_CLI], _COMPLETE, 1.0),
+    # Rendering help pulls in most of rich, through typer
+    "--help": (["-m", "docker_printer", "--help"], None, 2.0),
+}
+
+# Only needed once a command actually reads or writes configuration
+FORBIDDEN = [
+    "pydantic",
+    "jinja2",
+    "yaml",
+    "rich.tree",
+    "logging.config",
+    "docker_printer.models",
+    "docker_printer.utils",
+    "docker_printer.cache",
+]
+
+
+def import_times(
+    args: List[str], env: Optional[Dict[str, str]] = None
+) -> Tuple[float, Dict[str, float]]:
+    """Total import milliseconds, and cumulative milliseconds per imported module"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=dict(os.environ, **(env or {})),
+        check=True,
+    )
+    modules = {}
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # The header line
+        ms = int(cumulative) / 1000
+        modules[name.strip()] = ms
+        if not name[1:].startswith(" "):  # Top-level imports don't nest in others
+            total += ms
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[5:]),
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=200,
+        help="Budget for the quickest commands (--help gets a multiple of it)",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--verbose", action="store_true", help="List the slowest imports"
+    )
+    args = parser.parse_args()
+
+    ok = True
+    print(f"{'command':<14} {'import ms':>10}  result")
+    for name, (command, env, scale) in COMMANDS.items():
+        runs = [import_times(command, env) for _ in range(args.repeat)]
+        total, modules = min(runs, key=lambda run: run[0])
+        forbidden = [m for m in FORBIDDEN if m in modules]
+        budget = args.budget_ms * scale
+        problems = []
+        if forbidden:
+            problems.append(f"imports {', '.join(forbidden)}")
+        if total > budget:
+            problems.append(f"over the {budget:.0f} ms budget")
+        print(f"{name:<14} {total:>10.1f}  {'; '.join(problems) or 'ok'}")
+        if args.verbose:
+            slowest = sorted(modules.items(), key=lambda item: -item[1])[:10]
+            for module, ms in slowest:
+                print(f"{'':<14} {ms:>10.1f}  {module}")
+        ok = ok and not problems
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Benchmarks each phase of `synth` against generated projects
+
+Times every phase (best of `--repeat` cold runs) and records the peak memory it
+allocates. Results can be saved as a baseline and later runs compared against it;
+the exit status is non-zero when any phase regresses beyond `--tolerance`.
+
+Usage:
+    python -m benchmarks.run --preset small medium --save baseline.json
+    python -m benchmarks.run --preset small medium --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, ContextManager, Dict
+
+from docker_printer import __version__
+from docker_printer.models import (
+    BuildConfigCollection,
+    CommonListTree,
+    Registry,
+    TargetCollection,
+    resolve_dependencies,
+)
+from docker_printer.utils import (
+    builds_file,
+    jinja_env,
+    preload_modules,
+    project_cache_dir,
+    targets_file,
+    yml_load,
+)
+
+from .generate import generate_project
+
+PRESETS = {
+    "small": dict(modules=50, targets=20),
+    "medium": dict(modules=300, targets=500),
+    "large": dict(modules=1_000, targets=2_000, fanout=3, extends_depth=4),
+}
+
+PhaseHook = Callable[[str], ContextManager[None]]
+
+
+def _reset(project: Path):
+    """Forgets everything a previous run cached on disk, so each run starts cold"""
+    shutil.rmtree(project_cache_dir(project), ignore_errors=True)
+    os.chdir(project)
+
+
+def run_pipeline(project: Path, phase: PhaseHook):
+    _reset(project)
+    # A fresh registry has no modules, targets, or Jinja environment yet
+    with Registry(base_dir=project).activate():
+        _run_phases(phase)
+
+
+def _run_phases(phase: PhaseHook):
+    with phase("preload_modules"):
+        preload_modules()
+
+    with phase("parse_config"):
+        targets = TargetCollection.parse_obj(yml_load(targets_file()))
+        build_configs = BuildConfigCollection.parse_obj(yml_load(builds_file()))
+
+    with phase("resolve_dependencies"):
+        resolve_dependencies(targets.targets)
+
+    with phase("merge_tree"):
+        tree = CommonListTree()
+        for target in sorted(targets.targets, key=lambda t: t.name):
+            tree.merge_list(target.all_modules(), target.name)
+
+    with phase("render_dockerfile"):
+        with contextlib.redirect_stdout(io.StringIO()):  # Discard the printed tree
+            targets.render_dockerfile(jinja_env())
+
+    # What `build --image-store` and `--label-fingerprints` render
+    with phase("render_fingerprinted"):
+        fingerprints = {}
+        for _ in targets.iter_dockerfile(
+            jinja_env(), verbose=False, fingerprints=fingerprints
+        ):
+            pass
+
+    with phase("generate_bakefile"):
+        for build_config in build_configs.configs:
+            build_config.generate_bakefile(targets)
+
+
+def measure(project: Path, repeat: int) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+
+    @contextlib.contextmanager
+    def timed(name):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        entry = results.setdefault(name, {})
+        entry["seconds"] = min(entry.get("seconds", elapsed), elapsed)
+
+    @contextlib.contextmanager
+    def traced(name):
+        tracemalloc.start()
+        try:
+            yield
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results[name]["peak_mib"] = peak / 2**20
+
+    for _ in range(repeat):
+        run_pipeline(project, timed)
+    # Tracing slows allocation down, so memory is measured in a separate run
+    run_pipeline(project, traced)
+    return results
+
+
+def compare(results, baseline, tolerance: float) -> bool:
+    ok = True
+    for preset, phases in results.items():
+        for name, entry in phases.items():
+            before = baseline.get(preset, {}).get(name)
+            if before is None:
+                continue
+            ratio = entry["seconds"] / max(before["seconds"], 1e-9)
+            # Ignore sub-millisecond noise in phases that are nearly free
+            regressed = ratio > 1 + tolerance and entry["seconds"] > 1e-3
+            marker = "REGRESSION" if regressed else "ok"
+            print(f"{preset:>8} {name:<22} {ratio:>6.2f}x  {marker}")
+            ok = ok and not regressed
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[5:]),
+    )
+    parser.add_argument("--preset", nargs="*", choices=sorted(PRESETS))
+    parser.add_argument("--modules", type=int, help="Benchmark a custom project size")
+    parser.add_argument("--targets", type=int, default=100)
+    parser.add_argument("--fanout", type=int, default=2)
+    parser.add_argument("--extends-depth", type=int, default=2)
+    parser.add_argument("--template-size", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", type=Path, help="Write results as a baseline")
+    parser.add_argument("--compare", type=Path, help="Check results against a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    projects = {name: PRESETS[name] for name in args.preset or []}
+    if args.modules:
+        projects["custom"] = dict(
+            modules=args.modules,
+            targets=args.targets,
+            fanout=args.fanout,
+            extends_depth=args.extends_depth,
+            template_size=args.template_size,
+        )
+    if not projects:
+        projects["small"] = PRESETS["small"]
+
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for name, params in projects.items():
+                project = generate_project(Path(tmp) / name, **params)
+                results[name] = measure(project, args.repeat)
+        finally:
+            os.chdir(cwd)
+
+    print(f"{'project':>8} {'phase':<22} {'seconds':>9} {'peak MiB':>9}")
+    for name, phases in results.items():
+        for phase, entry in phases.items():
+            print(
+                f"{name:>8} {phase:<22} {entry['seconds']:>9.4f} "
+                f"{entry['peak_mib']:>9.2f}"
+            )
+
+    if args.save:
+        args.save.write_text(
+            json.dumps(
+                dict(
+                    docker_printer=__version__,
+                    python=platform.python_version(),
+                    projects=projects,
+                    results=results,
+                ),
+                indent=2,
+            )
+        )
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        print(
+            f"\nCompared with {args.compare} (docker-printer {baseline['docker_printer']})"
+        )
+        if not compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Stress benchmark for `CommonListTree`
+
+Builds a module tree for a growing number of synthetic targets and reports build time,
+labelling time and peak memory. Per-target cost should stay roughly flat as the target
+count grows, and deep module chains must not hit the recursion limit.
+
+Usage: python -m benchmarks.tree_stress [--max-targets 10000] [--depth 12]
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+from docker_printer.models import CommonListTree
+
+
+def synthetic_lists(n_targets: int, depth: int):
+    """Module chains that share progressively shorter prefixes, like a real target matrix"""
+    for i in range(n_targets):
+        chain = ["base"]
+        for level in range(1, depth):
+            # Deeper levels fan out more, so the tree branches like base -> group -> ...
+            chain.append(f"mod-{level}-{i % (level * 10)}")
+        chain.append(f"leaf-{i}")
+        yield f"target-{i}", chain
+
+
+def measure(n_targets: int, depth: int):
+    lists = list(synthetic_lists(n_targets, depth))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = CommonListTree()
+    for label, chain in lists:
+        tree.merge_list(chain, label)
+    built = time.perf_counter()
+
+    terminal_count = 0
+
+    def visit_node(value, node, parent):
+        nonlocal terminal_count
+        # Read repeatedly, as `TargetCollection.render_dockerfile` does
+        if len(node.terminal_labels) == 1:
+            terminal_count += len(node.terminal_labels)
+
+    tree.visit(visit_node)
+    visited = time.perf_counter()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert terminal_count == n_targets
+    return built - start, visited - built, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--max-targets", type=int, default=10_000)
+    parser.add_argument("--depth", type=int, default=12)
+    args = parser.parse_args()
+
+    sizes = [n for n in (500, 1_000, 2_000, 5_000, 10_000) if n <= args.max_targets]
+    print(
+        f"{'targets':>8} {'merge s':>9} {'visit s':>9} {'peak MiB':>9} "
+        f"{'us/target':>10} {'KiB/target':>11}"
+    )
+    for n in sizes:
+        merge, visit, peak = measure(n, args.depth)
+        print(
+            f"{n:>8} {merge:>9.3f} {visit:>9.3f} {peak / 2**20:>9.1f} "
+            f"{(merge + visit) / n * 1e6:>10.1f} {peak / n / 1024:>11.2f}"
+        )
+
+    # A single chain far deeper than the interpreter's recursion limit
+    deep = sys.getrecursionlimit() * 2
+    tree = CommonListTree()
+    tree.merge_list([f"mod-{i}" for i in range(deep)], "deep")
+    nodes = []
+    tree.visit(lambda value, node, parent: nodes.append(node))
+    assert len(nodes) == deep and nodes[-1].terminal_labels == {"deep"}
+    print(f"\nChain of {deep} modules merged and visited without recursion")
+
+
+if __name__ == "__main__":
+    main()
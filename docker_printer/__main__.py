@@ -1,11 +1,13 @@
 import logging
 import sys
-from logging.config import dictConfig
 
 log = logging.getLogger(__name__)
 
 
-def main():
+def configure_logging():
+    # Called once a command runs, rather than for `--version`, `--help`, or completion
+    from logging.config import dictConfig
+
     dictConfig(
         dict(
             version=1,
@@ -58,6 +60,8 @@ def main():
         )
     )
 
+
+def main():
     from docker_printer.cli import app
 
     app()
@@ -0,0 +1,205 @@
+"""Which targets a set of changed config files affects, so CI can rebuild only those."""
+
+import subprocess
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+import jinja2
+import yaml
+from jinja2 import meta
+
+from .cache import ModuleParseCache
+from .models import Module, Target
+from .utils import (
+    YamlLoader,
+    _parse_module,
+    module_files,
+    targets_file,
+    targets_source,
+    yml_load,
+)
+
+# Rendered for every Dockerfile (and for targets' bare stages), whatever the modules
+ALWAYS_RENDERED = ["base.Dockerfile.jinja2", "stage.Dockerfile.jinja2"]
+
+
+class TemplateGraph:
+    """Which templates each template includes, imports, or extends, by name"""
+
+    def __init__(self, environment: jinja2.Environment):
+        self.environment = environment
+        self._references: Dict[str, Set[Optional[str]]] = {}
+        self._paths: Dict[str, Path] = {}
+
+    def references(self, name: str) -> Set[Optional[str]]:
+        """Templates `name` refers to directly, with None for any whose name is computed"""
+        if name not in self._references:
+            source, _, _ = self.environment.loader.get_source(self.environment, name)
+            ast = self.environment.parse(source)
+            self._references[name] = set(meta.find_referenced_templates(ast))
+        return self._references[name]
+
+    def closure(self, name: str) -> Set[Optional[str]]:
+        """`name` and every template it uses, directly or not"""
+        seen: Set[Optional[str]] = set()
+        stack: List[Optional[str]] = [name]
+        while stack:
+            current = stack.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            if current is not None:
+                stack.extend(self.references(current))
+        return seen
+
+    def contains(self, path: Path) -> bool:
+        """Whether `path` is somewhere templates are loaded from"""
+        searchpath = getattr(self.environment.loader, "searchpath", None)
+        if searchpath is None:
+            return True
+        return any(Path(root).resolve() in path.parents for root in searchpath)
+
+    def path(self, name: str) -> Path:
+        """The file `name` is loaded from, after project templates override built-ins"""
+        if name not in self._paths:
+            _, filename, _ = self.environment.loader.get_source(self.environment, name)
+            self._paths[name] = Path(filename).resolve()
+        return self._paths[name]
+
+
+def module_names_by_file(parse_cache: ModuleParseCache) -> Dict[Path, str]:
+    """The name of the module each module file defines"""
+    names = {}
+    for path in module_files():
+        module = parse_cache.get(path) or _parse_module(path)
+        names[path.resolve()] = module.name
+    return names
+
+
+def changed_target_names(old: Optional[list], new: list) -> Optional[Set[str]]:
+    """Targets that were added or whose definitions changed between two versions of
+    the parsed `targets.yml`, or None if they can't be compared
+    """
+    if not isinstance(old, list):
+        return None
+    try:
+        before = {t["name"]: t for t in old}
+    except (KeyError, TypeError):
+        return None
+    return {t["name"] for t in new if before.get(t["name"]) != t}
+
+
+def changed_modules(
+    changed: Set[Path],
+    modules: Iterable[Module],
+    module_files: Dict[Path, str],
+    templates: TemplateGraph,
+) -> Optional[Set[str]]:
+    """The names of the `modules` that a change to the `changed` files (resolved
+    paths) changes, directly or through a template they use, or None if it changes
+    every stage
+    """
+    if any(templates.path(name) in changed for name in ALWAYS_RENDERED):
+        return None
+    names = {name for path, name in module_files.items() if path in changed}
+    changed_templates = any(templates.contains(path) for path in changed)
+    for module in modules:
+        if module.name in names:
+            continue
+        used = templates.closure(module.template.file)
+        # A template included by a computed name could be any of them
+        if None in used and changed_templates:
+            names.add(module.name)
+        elif any(templates.path(name) in changed for name in used if name):
+            names.add(module.name)
+    return names
+
+
+def affected_targets(
+    changed: Iterable[Path],
+    targets: List[Target],
+    module_files: Dict[Path, str],
+    templates: TemplateGraph,
+    config_files: Iterable[Path] = (),
+    changed_targets: Optional[Set[str]] = None,
+) -> List[Target]:
+    """The targets in `targets` whose images a change to the `changed` files can affect
+
+    `module_files` maps each module file to the module it defines, and `config_files`
+    are files that every target depends on: `builds.yml`, and `targets.yml` unless
+    `changed_targets` names the targets changed in it.
+    """
+    changed = {Path(path).resolve() for path in changed}
+    everything = sorted(targets, key=lambda t: t.name)
+    if changed & {Path(path).resolve() for path in config_files}:
+        return everything
+
+    used = {
+        module.name: module for target in targets for module in target.all_modules()
+    }
+    modules = changed_modules(changed, used.values(), module_files, templates)
+    if modules is None:
+        return everything
+
+    changed_targets = changed_targets or set()
+    return [
+        target
+        for target in everything
+        if any(module.name in modules for module in target.all_modules())
+        or any(t.name in changed_targets for t in target.all_targets())
+    ]
+
+
+def git(*args: str, cwd: Path) -> str:
+    """The output of a git command run in `cwd`, raising RuntimeError if it fails"""
+    result = subprocess.run(
+        ["git", *args],
+        cwd=str(cwd),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"git {' '.join(args)} failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+def git_changed_files(revisions: str, cwd: Path) -> List[Path]:
+    """Files under `cwd` that differ in `revisions` (e.g. `main...HEAD`, or just `main`
+    to compare against the working tree), as git diff sees them
+    """
+    output = git("diff", "--name-only", "--relative", "-z", revisions, cwd=cwd)
+    return [cwd / name for name in output.split("\0") if name]
+
+
+def git_base_revision(revisions: str, cwd: Path) -> str:
+    """The revision `revisions` compares against"""
+    if "..." in revisions:
+        left, right = revisions.split("...", 1)
+        return git("merge-base", left or "HEAD", right or "HEAD", cwd=cwd).strip()
+    return revisions.split("..", 1)[0] or "HEAD"
+
+
+def git_show(revision: str, path: Path, cwd: Path) -> Optional[str]:
+    """The contents of `path` at `revision`, or None if it didn't exist then"""
+    relative = path.resolve().relative_to(cwd.resolve())
+    try:
+        return git("show", f"{revision}:./{relative.as_posix()}", cwd=cwd)
+    except RuntimeError:
+        return None
+
+
+def targets_changed_since(revision: str, cwd: Path) -> Optional[Set[str]]:
+    """Targets added or changed in `targets.yml` since `revision`, or None if its
+    earlier version is missing or can't be parsed
+    """
+    source = targets_source()
+    old = git_show(revision, source, cwd)
+    if old is None:
+        return None
+    try:
+        if source.suffix == ".jinja2":
+            old = jinja2.Template(old).render()
+        old_targets = yaml.load(old, Loader=YamlLoader)
+    except (jinja2.TemplateError, yaml.YAMLError):
+        return None
+    return changed_target_names(old_targets, yml_load(targets_file()))
@@ -0,0 +1,98 @@
+"""Synthesizing every project below a directory, several at a time."""
+
+import contextlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional
+
+# Folders that never hold projects, and can be large enough to make discovery slow
+SKIPPED_DIRS = {"node_modules", "__pycache__", "venv", "site-packages"}
+
+
+class ProjectResult(NamedTuple):
+    path: Path
+    status: str  # "synthesized", "up to date", or "failed"
+    seconds: float
+    output: str
+
+    @property
+    def ok(self) -> bool:
+        return self.status != "failed"
+
+
+def find_projects(root: Path) -> List[Path]:
+    """Every directory at or below `root` that contains a `docker-printer` folder"""
+    projects = []
+    for dirpath, dirnames, _ in os.walk(str(root)):
+        if "docker-printer" in dirnames:
+            projects.append(Path(dirpath))
+        dirnames[:] = sorted(
+            d
+            for d in dirnames
+            if d != "docker-printer" and d not in SKIPPED_DIRS and d[0] != "."
+        )
+    return projects
+
+
+def synth_project(path: Path, **options) -> ProjectResult:
+    """Synthesizes the project in `path` as `synth` would, capturing its output
+
+    Projects share one bytecode cache, in Jinja's default location, so built-in
+    templates are compiled once for all of them.
+    """
+    import jinja2
+
+    from .cli import _synth
+    from .models import Registry
+    from .utils import create_jinja_env, template_dirs
+
+    start = time.perf_counter()
+    output = io.StringIO()
+    registry = Registry(base_dir=path)
+    with registry.activate(), contextlib.redirect_stdout(output):
+        try:
+            registry.environment = create_jinja_env(
+                jinja2.FileSystemLoader(template_dirs()), _shared_bytecode_cache()
+            )
+            synthesized = _synth(**options)
+        except Exception as e:
+            print(f"Error: {e}")
+            status = "failed"
+        else:
+            status = "synthesized" if synthesized else "up to date"
+    return ProjectResult(path, status, time.perf_counter() - start, output.getvalue())
+
+
+_bytecode_cache = None
+
+
+def _shared_bytecode_cache():
+    global _bytecode_cache
+    if _bytecode_cache is None:
+        import jinja2
+
+        _bytecode_cache = jinja2.FileSystemBytecodeCache()
+    return _bytecode_cache
+
+
+def synth_projects(
+    projects: List[Path],
+    workers: Optional[int] = None,
+    on_result: Callable[[ProjectResult], None] = None,
+    **options,
+) -> List[ProjectResult]:
+    """Synthesizes `projects` across a pool of worker processes, each of which handles
+    many projects in turn, returning the results in the order of `projects`
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(synth_project, path, **options) for path in projects]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result.path] = result
+            if on_result is not None:
+                on_result(result)
+    return [results[path] for path in projects]
@@ -0,0 +1,324 @@
+"""Content-hashed bookkeeping that lets `synth` skip work whose inputs are unchanged."""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import jinja2
+import pydantic
+
+from . import __version__
+from .models import Module
+from .output import file_digest
+from .utils import (
+    builds_source,
+    builds_template_context,
+    module_files,
+    targets_source,
+    template_files,
+)
+
+MANIFEST_FORMAT = 4
+PARSE_CACHE_FORMAT = 1
+
+# What unpickling a corrupt entry, or one pickled by other versions, may raise
+UNPICKLING_ERRORS = (
+    pickle.UnpicklingError,
+    EOFError,
+    AttributeError,
+    ImportError,
+    IndexError,
+    TypeError,
+    ValueError,
+)
+
+# Files modified this close to when they were hashed may have changed again within
+# the same mtime tick, so their stat information is not trusted on the next run.
+_RACY_WINDOW_NS = 2_000_000_000
+
+
+def _is_settled(stat: os.stat_result) -> bool:
+    return time.time_ns() - stat.st_mtime_ns > _RACY_WINDOW_NS
+
+
+def data_digest(*parts: Any) -> str:
+    encoded = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _read_json(path: Path, format: int) -> Optional[dict]:
+    try:
+        data = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("format") != format:
+        return None
+    return data
+
+
+def _write_json(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+class SynthManifest:
+    """Hashes of every `synth` input and output from the last run, the chunks it
+    rendered, and the fingerprints of the stages in each Dockerfile
+
+    Chunks are kept in a file of their own, which is only read when something needs
+    rendering, so checking whether outputs are up to date stays quick.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        files: Dict[str, list] = None,
+        inputs: Dict[str, str] = None,
+        outputs: Dict[str, str] = None,
+        chunks: Dict[str, str] = None,
+        fingerprints: Dict[str, Dict[str, str]] = None,
+        ignore_files: List[str] = None,
+    ):
+        self.path = path
+        self.files = files or {}
+        self.inputs = inputs or {}
+        self.outputs = outputs or {}
+        self._chunks = chunks
+        self._chunks_changed = False
+        # Dockerfile name -> stage name -> fingerprint
+        self.fingerprints = fingerprints or {}
+        # The `.dockerignore` files of build contexts that generated ones fold in
+        self.ignore_files = ignore_files or []
+        self._stats: Dict[str, list] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> "SynthManifest":
+        data = _read_json(path, MANIFEST_FORMAT)
+        if data is None:
+            return cls(path)
+        return cls(
+            path,
+            files=data["files"],
+            inputs=data["inputs"],
+            outputs=data["outputs"],
+            fingerprints=data["fingerprints"],
+            ignore_files=data["ignore_files"],
+        )
+
+    @property
+    def chunks_path(self) -> Path:
+        return self.path.with_name(self.path.stem + ".chunks.json")
+
+    @property
+    def chunks(self) -> Dict[str, str]:
+        """Chunks rendered by the last run, by `ChunkCache` key"""
+        if self._chunks is None:
+            data = _read_json(self.chunks_path, MANIFEST_FORMAT)
+            self._chunks = {} if data is None else data["chunks"]
+        return self._chunks
+
+    def save(self):
+        if self._chunks_changed:
+            _write_json(
+                self.chunks_path, dict(format=MANIFEST_FORMAT, chunks=self._chunks)
+            )
+            self._chunks_changed = False
+        _write_json(
+            self.path,
+            dict(
+                format=MANIFEST_FORMAT,
+                files=self._stats,
+                inputs=self.inputs,
+                outputs=self.outputs,
+                fingerprints=self.fingerprints,
+                ignore_files=self.ignore_files,
+            ),
+        )
+
+    def digest(self, path: Path) -> str:
+        """Content hash of `path`, reusing the previous hash when its stat is unchanged"""
+        stat = path.stat()
+        key = str(path)
+        cached = self.files.get(key)
+        if cached and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+            digest = cached[2]
+        else:
+            digest = file_digest(path)
+
+        if _is_settled(stat):
+            self._stats[key] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def collect_inputs(self) -> Dict[str, str]:
+        if self._stats:  # Reused in-process, e.g. by `watch`
+            self.files, self._stats = self._stats, {}
+        inputs = dict(version=__version__)
+        for f in module_files():
+            inputs[f"module:{f}"] = self.digest(f)
+        inputs["templates"] = data_digest(
+            sorted((str(f), self.digest(f)) for f in template_files())
+        )
+        inputs["targets"] = self.digest(targets_source())
+        builds_path = builds_source()
+        inputs["builds"] = self.digest(builds_path)
+        if builds_path.suffix == ".jinja2":
+            inputs["builds-context"] = data_digest(builds_template_context())
+        inputs.update(self.ignore_inputs(self.ignore_files))
+        return inputs
+
+    def ignore_inputs(self, paths: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Hashes of the context `.dockerignore` files in `paths`, None if missing"""
+        inputs = {}
+        for name in paths:
+            path = Path(name)
+            inputs[f"dockerignore:{name}"] = (
+                self.digest(path) if path.exists() else None
+            )
+        return inputs
+
+    def is_up_to_date(self, inputs: Dict[str, str]) -> bool:
+        if inputs != self.inputs or not self.outputs:
+            return False
+        for name, digest in self.outputs.items():
+            path = Path(name)
+            if not path.exists() or self.digest(path) != digest:
+                return False
+        return True
+
+    def record(
+        self,
+        inputs: Dict[str, str],
+        outputs: Dict[str, str],
+        chunks,
+        fingerprints: Dict[str, Dict[str, str]] = None,
+        ignore_files: List[str] = (),
+    ):
+        self.inputs = inputs
+        self.outputs = outputs
+        if chunks != self._chunks:
+            self._chunks = chunks
+            self._chunks_changed = True
+        self.fingerprints = fingerprints or {}
+        self.ignore_files = sorted(ignore_files)
+
+
+class ChunkCache:
+    """Reuses rendered module chunks whose template, variables, and stage names are unchanged"""
+
+    def __init__(self, chunks: Optional[Dict[str, str]] = None, salt: str = ""):
+        self.previous = chunks or {}
+        self.current: Dict[str, str] = {}
+        self.salt = salt
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, module: Module, prev_name, cur_name) -> str:
+        return data_digest(self.salt, module.template.dict(), prev_name, cur_name)
+
+    def get(self, key: str) -> Optional[str]:
+        """The chunk rendered for `key`, this run or the last, if there is one"""
+        chunk = self.current.get(key)
+        if chunk is None:
+            chunk = self.previous.get(key)
+        if chunk is not None:
+            self.hits += 1
+            self.current[key] = chunk
+        return chunk
+
+    def put(self, key: str, chunk: str):
+        self.misses += 1
+        self.current[key] = chunk
+
+    def get_chunk(
+        self, module: Module, environment: jinja2.Environment, prev_name, cur_name
+    ) -> str:
+        key = self.key(module, prev_name, cur_name)
+        chunk = self.get(key)
+        if chunk is None:
+            chunk = module.get_chunk(environment, prev_name, cur_name)
+            self.put(key, chunk)
+        return chunk
+
+
+class ModuleParseCache:
+    """Validated modules from previous runs, keyed by file path, mtime and size
+
+    Only used while the docker-printer and pydantic versions match the ones that
+    pickled it.
+    """
+
+    def __init__(self, path: Path, entries: Dict[str, tuple] = None):
+        self.path = path
+        self.entries = entries or {}
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: Path) -> "ModuleParseCache":
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except (OSError, *UNPICKLING_ERRORS):
+            return cls(path)
+        if not isinstance(data, dict) or (
+            data.get("format") != PARSE_CACHE_FORMAT
+            or data.get("versions") != [__version__, pydantic.VERSION]
+        ):
+            return cls(path)
+        return cls(path, data["entries"])
+
+    def save(self):
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                dict(
+                    format=PARSE_CACHE_FORMAT,
+                    versions=[__version__, pydantic.VERSION],
+                    entries=self.entries,
+                ),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def retain(self, paths):
+        """Forgets cached modules for files that no longer exist"""
+        keep = {str(path) for path in paths}
+        stale = [key for key in self.entries if key not in keep]
+        for key in stale:
+            del self.entries[key]
+        self._dirty = self._dirty or bool(stale)
+
+    def get(self, path: Path) -> Optional[Module]:
+        entry = self.entries.get(str(path))
+        if entry is None:
+            return None
+        stat = path.stat()
+        if entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            return None
+        try:
+            return pickle.loads(entry[2])
+        except UNPICKLING_ERRORS:
+            return None  # Parsed again, and replaced, like a changed file
+
+    def put(self, path: Path, module: Module):
+        stat = path.stat()
+        if not _is_settled(stat):
+            self.entries.pop(str(path), None)
+            return
+        # Store a pickled snapshot so later mutations (e.g. resolved closures) aren't cached
+        self.entries[str(path)] = (
+            stat.st_mtime_ns,
+            stat.st_size,
+            pickle.dumps(module, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+        self._dirty = True
@@ -1,20 +1,22 @@
 import os
-import subprocess
 import textwrap
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import typer
 
-from . import __version__
-from .models import BuildConfigCollection, TargetCollection
-from .utils import (
-    base_dir,
-    builds_file,
-    jinja_env,
-    preload_modules,
-    targets_file,
-    yml_load,
-)
+from . import __version__, profiling
+
+# Everything else (pydantic, jinja2, yaml, rich's renderables) is imported inside the
+# commands that need it, so `--version`, `--help`, and shell completion start quickly
+if TYPE_CHECKING:
+    from .cache import ModuleParseCache, SynthManifest
+    from .layers import LayerSavings
+    from .models import BuildConfigCollection, TargetCollection
+
+    ConfigLoader = Callable[
+        [Optional[ModuleParseCache]], Tuple[TargetCollection, BuildConfigCollection]
+    ]
 
 app = typer.Typer()
 
@@ -32,52 +34,502 @@ def base_dir_callback(value: str = None):
         os.chdir(str(resoled_value))
 
 
+def _finish_profile(profiler: profiling.Profiler, trace_path: Path):
+    profiling.disable()
+    profiler.write_trace(trace_path)
+    typer.echo(profiler.summary(), err=True)
+    typer.echo(f"Saved trace to {trace_path}", err=True)
+
+
 @app.callback()
 def main(
+    ctx: typer.Context,
     version: bool = typer.Option(
         None, "--version", callback=version_callback, is_eager=True
     ),
     base_dir: str = typer.Option(
         None, "--basedir", callback=base_dir_callback, is_eager=True
     ),
+    profile: Path = typer.Option(
+        None,
+        "--profile",
+        help="Time each phase and module, and save a Chrome trace to this path.",
+        dir_okay=False,
+    ),
 ):
     # Do other global stuff, handle other global options here
-    return
+    from .__main__ import configure_logging
+
+    configure_logging()
+    if profile:
+        profiler = profiling.enable()
+        ctx.call_on_close(lambda: _finish_profile(profiler, profile.resolve()))
+
+
+def _preload_modules(parse_cache: "ModuleParseCache" = None):
+    from .cache import ModuleParseCache
+    from .utils import cache_dir, preload_modules
+
+    with profiling.span("load_modules"):
+        if parse_cache is None:
+            parse_cache = ModuleParseCache.load(cache_dir() / "modules.pickle")
+        preload_modules(parse_cache)
+        parse_cache.save()
+
+
+def _load_config(
+    parse_cache: "ModuleParseCache" = None,
+) -> Tuple["TargetCollection", "BuildConfigCollection"]:
+    """Registers the project's modules and targets, and parses its build configs
+
+    Uses the compiled snapshot if there is an up-to-date one, and otherwise loads from
+    source, refreshing the snapshot if there is an outdated one.
+    """
+    from .snapshot import ConfigSnapshot, snapshot_path
+
+    with profiling.span("load_snapshot"):
+        snapshot = ConfigSnapshot.load(snapshot_path())
+    if snapshot is not None:
+        snapshot.register()
+        return snapshot.targets, snapshot.builds
+
+    targets, build_configs = _parse_config(parse_cache)
+    if snapshot_path().exists():
+        with profiling.span("compile_snapshot"):
+            ConfigSnapshot.compile(targets, build_configs).save(snapshot_path())
+    return targets, build_configs
+
+
+def _parse_config(
+    parse_cache: "ModuleParseCache" = None,
+) -> Tuple["TargetCollection", "BuildConfigCollection"]:
+    from .models import BuildConfigCollection, TargetCollection
+    from .utils import builds_file, targets_file, yml_load
+
+    _preload_modules(parse_cache)
+    with profiling.span("parse_targets"):
+        targets = TargetCollection.parse_obj(yml_load(targets_file()))
+    with profiling.span("parse_builds"):
+        build_configs = BuildConfigCollection.parse_obj(yml_load(builds_file()))
+    return targets, build_configs
+
+
+MERGE_STAGES_OPTION = typer.Option(
+    False,
+    "--merge-stages",
+    help="Emit identical stages only once, even where targets' module lists differ.",
+)
+LABEL_FINGERPRINTS_OPTION = typer.Option(
+    False,
+    "--label-fingerprints",
+    help="Label each stage with its fingerprint.",
+)
+OPTIMIZE_LAYERS_OPTION = typer.Option(
+    False,
+    "--optimize-layers",
+    help="Merge consecutive RUN, ENV, and LABEL instructions where safe, and fold "
+    "bare target stages away.",
+)
+RENDER_WORKERS_OPTION = typer.Option(
+    None, help="Render stages on this many processes at once (default: one by one)."
+)
 
 
 @app.command()
-def synth():
+def synth(
+    force: bool = typer.Option(
+        False, "--force", help="Re-synthesize even if no inputs have changed."
+    ),
+    merge_stages: bool = MERGE_STAGES_OPTION,
+    label_fingerprints: bool = LABEL_FINGERPRINTS_OPTION,
+    optimize_layers: bool = OPTIMIZE_LAYERS_OPTION,
+    render_workers: int = RENDER_WORKERS_OPTION,
+    target: List[str] = typer.Option(
+        None,
+        "--target",
+        "-t",
+        help="Only synthesize this target (and what it builds on). Can be repeated.",
+    ),
+    all_projects: bool = typer.Option(
+        False,
+        "--all",
+        help="Synthesize every project at or below the current directory.",
+    ),
+    workers: int = typer.Option(
+        None, help="Projects to synthesize at once with --all (default: CPU count)."
+    ),
+):
     """Synthesizes new Dockerfiles from configuration."""
-    _synth()
+    if all_projects:
+        if target:
+            typer.secho("Error: --target can't be used with --all", fg=typer.colors.RED)
+            raise typer.Exit(1)
+        _synth_all(
+            workers,
+            force=force,
+            merge_stages=merge_stages,
+            label_fingerprints=label_fingerprints,
+            optimize_layers=optimize_layers,
+        )
+        return
+    args = dict(
+        force=force,
+        merge_stages=merge_stages,
+        label_fingerprints=label_fingerprints,
+        optimize_layers=optimize_layers,
+        only_targets=target or None,
+        render_workers=render_workers,
+    )
+    if not _via_daemon("synth", **args):
+        _synth(**args)
+
+
+def _synth_all(workers: int = None, **options):
+    import time
+
+    from .batch import ProjectResult, find_projects, synth_projects
+
+    root = Path().resolve()
+    projects = find_projects(root)
+    if not projects:
+        typer.secho(f"Error: No projects found in {root}", fg=typer.colors.RED)
+        raise typer.Exit(1)
+    typer.echo(f"Synthesizing {len(projects)} project(s) in {root}")
+
+    colors = {"failed": typer.colors.RED, "synthesized": typer.colors.GREEN}
+
+    def report(result: ProjectResult):
+        name = str(result.path.relative_to(root))
+        typer.secho(
+            f"{result.seconds:8.2f}s  {result.status:<11}  {name}",
+            fg=colors.get(result.status),
+        )
+        if not result.ok:
+            typer.echo(textwrap.indent(result.output.rstrip("\n"), " " * 11))
+
+    start = time.perf_counter()
+    results = synth_projects(projects, workers, on_result=report, **options)
+    failed = [result for result in results if not result.ok]
+    typer.echo(
+        f"{len(results) - len(failed)} of {len(results)} project(s) succeeded "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    if failed:
+        raise typer.Exit(1)
+
+
+def _via_daemon(command: str, **args) -> bool:
+    """Has a running `serve` process do the work, returning False if there isn't one"""
+    if profiling.is_enabled():  # Profile the work itself, in this process
+        return False
+    from .daemon import request
+
+    response = request(command, **args)
+    if response is None:
+        return False
+    typer.echo(response["output"], nl=False)
+    if response["exit_code"]:
+        raise typer.Exit(response["exit_code"])
+    return True
+
+
+def _synth(
+    force: bool = False,
+    manifest: "SynthManifest" = None,
+    parse_cache: "ModuleParseCache" = None,
+    merge_stages: bool = False,
+    only_targets: List[str] = None,
+    render_workers: int = None,
+    label_fingerprints: bool = False,
+    optimize_layers: bool = False,
+    load_config: "ConfigLoader" = None,
+    record_fingerprints: bool = False,
+) -> bool:
+    """Synthesizes the project's outputs, returning False if they were up to date
+
+    `load_config` replaces `_load_config`, e.g. with one that keeps the config loaded.
+    Stage fingerprints are only recorded in the manifest with `record_fingerprints`
+    or `label_fingerprints`, as computing them takes a while on large projects.
+    """
+    from .cache import ChunkCache, SynthManifest, data_digest
+    from .output import write_if_changed
+    from .utils import base_dir, cache_dir, jinja_env
+
+    with profiling.span("check_manifest"):
+        if manifest is None:
+            manifest = SynthManifest.load(cache_dir() / "synth-manifest.json")
+        inputs = manifest.collect_inputs()
+        inputs["options"] = data_digest(
+            dict(
+                merge_stages=merge_stages,
+                only_targets=sorted(only_targets or []),
+                label_fingerprints=label_fingerprints,
+                optimize_layers=optimize_layers,
+            )
+        )
+        up_to_date = (
+            not force
+            and manifest.is_up_to_date(inputs)
+            and (manifest.fingerprints or not record_fingerprints)
+        )
+    if up_to_date:
+        typer.echo("Nothing to synthesize, all outputs are up to date")
+        return False
 
+    targets, build_configs = (load_config or _load_config)(parse_cache)
+    if only_targets:
+        try:
+            targets = targets.subset(only_targets)
+        except ValueError as e:
+            typer.secho(f"Error: {e}", fg=typer.colors.RED)
+            raise typer.Exit(1)
 
-def _synth():
-    preload_modules()
+    chunk_cache = ChunkCache(
+        manifest.chunks, salt=data_digest(inputs["version"], inputs["templates"])
+    )
+    outputs = {}
+    fingerprints = {}
 
-    targets = TargetCollection.parse_obj(yml_load(targets_file()))
-    build_configs = BuildConfigCollection.parse_obj(yml_load(builds_file()))
+    def write_dockerfile(name: str, target_names: List[str] = None):
+        if record_fingerprints or label_fingerprints:
+            fingerprints[name] = {}
+        layer_savings = {} if optimize_layers else None
+        dockerfile = targets.iter_dockerfile(
+            jinja_env(),
+            target_names,
+            chunk_cache=chunk_cache,
+            merge_duplicates=merge_stages,
+            title=name,
+            workers=render_workers,
+            fingerprints=fingerprints.get(name),
+            label_fingerprints=label_fingerprints,
+            layer_savings=layer_savings,
+        )
+        dockerfile_path = base_dir() / name
+        typer.echo(f"Saving to {dockerfile_path}")
+        with profiling.span("write_dockerfile", dockerfile=name):
+            outputs[str(dockerfile_path)] = write_if_changed(
+                dockerfile_path, dockerfile
+            ).digest
+        if layer_savings is not None:
+            _print_layer_savings(
+                name, layer_savings, target_names or [t.name for t in targets.select()]
+            )
 
-    dockerfile = targets.render_dockerfile(jinja_env())
-    dockerfile_path = base_dir() / "Dockerfile.synth"
+    write_dockerfile("Dockerfile.synth")
+    for build_config in build_configs.configs:
+        if build_config.prune:
+            write_dockerfile(
+                build_config.dockerfile_name,
+                [t.name for t in build_config.select_targets(targets)],
+            )
 
-    typer.echo(f"Saving to {dockerfile_path}")
-    with open(dockerfile_path, "w", newline="\n") as f:
-        f.write(dockerfile)
+    ignored = {}  # Dockerfile name -> context directory
+    for build_config in build_configs.configs:
+        if build_config.dockerignore:
+            ignored.setdefault(build_config.dockerfile_name, set()).add(
+                build_config.context_dir
+            )
+    # Generated ignore files fold in their context's, so it's an input from now on
+    ignore_files = sorted(
+        {
+            str(base_dir() / context / ".dockerignore")
+            for contexts in ignored.values()
+            for context in contexts
+        }
+    )
+    inputs.update(manifest.ignore_inputs(ignore_files))
+    for name, contexts in ignored.items():
+        with profiling.span("write_dockerignore", dockerfile=name):
+            written = _write_dockerignore(name, contexts)
+        if written is not None:
+            outputs[str(written[0])] = written[1]
+    _remove_stale_dockerignores(ignored)
 
+    with profiling.span("generate_bakefiles"):
+        bakefiles = build_configs.generate_bakefiles(targets)
     for build_config in build_configs.configs:
-        bakefile_path = base_dir() / f"docker-bake.{build_config.name}.json"
-        bakefile = build_config.generate_bakefile(targets)
-        with open(bakefile_path, "w", newline="\n") as f:
-            f.write(bakefile + "\n")
+        bakefile_path = base_dir() / build_config.bakefile_name
+        with profiling.span("write_bakefile", config=build_config.name):
+            outputs[str(bakefile_path)] = write_if_changed(
+                bakefile_path, [bakefiles[build_config.name], "\n"]
+            ).digest
         typer.echo(build_config.build_command)
 
-    return targets, build_configs
+    with profiling.span("save_manifest"):
+        manifest.record(
+            inputs,
+            outputs=outputs,
+            chunks=chunk_cache.current,
+            fingerprints=fingerprints,
+            ignore_files=ignore_files,
+        )
+        manifest.save()
+    return True
+
+
+def _print_layer_savings(
+    name: str, savings: Dict[str, "LayerSavings"], target_names: List[str]
+):
+    from .layers import savings_by_target
+
+    totals = savings_by_target(savings, target_names)
+    saved = {target: total for target, total in totals.items() if any(total)}
+    if not saved:
+        typer.echo(f"Optimized {name}: nothing to consolidate")
+        return
+    typer.echo(f"Optimized {name}:")
+    width = max(len(target) for target in saved)
+    for target, (layers, instructions) in sorted(saved.items()):
+        typer.echo(
+            f"  {target:<{width}}  {layers} layer(s) and "
+            f"{instructions} instruction(s) removed"
+        )
+
+
+def _remove_stale_dockerignores(keep: Iterable[str]):
+    """Removes the ignore files synth wrote for Dockerfiles other than `keep`"""
+    from .context import is_generated
+    from .utils import base_dir
+
+    keep = {f"{name}.dockerignore" for name in keep}
+    for path in base_dir().glob("*.dockerignore"):
+        if path.name not in keep and is_generated(path):
+            typer.echo(f"Removing {path.name}, which no build config asks for")
+            path.unlink()
+
+
+def _write_dockerignore(name: str, contexts: Set[str]) -> Optional[Tuple[Path, str]]:
+    """Writes an ignore file for Dockerfile `name` that leaves only the files it uses
+    in the build context, reporting the context's size before and after
+    """
+    from .context import (
+        ContextError,
+        context_size,
+        context_sources,
+        dockerignore_lines,
+        is_generated,
+        read_patterns,
+    )
+    from .output import write_if_changed
+    from .utils import base_dir
+
+    ignore_path = base_dir() / f"{name}.dockerignore"
+    try:
+        if len(contexts) > 1:
+            raise ContextError("its build configs use different contexts")
+        context = base_dir() / contexts.pop()
+        sources = context_sources((base_dir() / name).read_text())
+    except ContextError as e:
+        typer.secho(
+            f"Not narrowing the build context for {name}: {e}", fg=typer.colors.YELLOW
+        )
+        if is_generated(ignore_path):
+            ignore_path.unlink()  # It may leave out files the Dockerfile now uses
+        return None
+
+    # A Dockerfile's own ignore file replaces the context's, so keep its exclusions
+    exclusions = [
+        pattern
+        for pattern in read_patterns(context / ".dockerignore")
+        if not pattern.startswith("!")
+    ]
+    lines = dockerignore_lines(name, sources, exclusions)
+    digest = write_if_changed(ignore_path, lines).digest
+    before = context_size(context, read_patterns(context / ".dockerignore"))
+    after = context_size(context, [line.rstrip("\n") for line in lines[1:]])
+    typer.echo(f"Build context for {name}: {before} -> {after}")
+    return ignore_path, digest
+
+
+@app.command()
+def watch(
+    interval: float = typer.Option(
+        0.5, help="Seconds between checks for changed files."
+    ),
+    debounce: float = typer.Option(
+        0.3, help="Seconds without further changes before re-synthesizing."
+    ),
+    merge_stages: bool = MERGE_STAGES_OPTION,
+    label_fingerprints: bool = LABEL_FINGERPRINTS_OPTION,
+    optimize_layers: bool = OPTIMIZE_LAYERS_OPTION,
+    render_workers: int = RENDER_WORKERS_OPTION,
+):
+    """Re-synthesizes whenever modules, templates, targets, or builds change."""
+    from .cache import ModuleParseCache, SynthManifest
+    from .models import Module, Target
+    from .utils import cache_dir, config_dir, jinja_env, watched_files
+    from .watch import watch_changes
+
+    manifest = SynthManifest.load(cache_dir() / "synth-manifest.json")
+    parse_cache = ModuleParseCache.load(cache_dir() / "modules.pickle")
+    template_dir = config_dir() / "templates"
+
+    def resynth():
+        # Modules and targets are re-registered from the in-memory caches each time
+        Module.__modules__.clear()
+        Target.__targets__.clear()
+        try:
+            _synth(
+                manifest=manifest,
+                parse_cache=parse_cache,
+                merge_stages=merge_stages,
+                label_fingerprints=label_fingerprints,
+                optimize_layers=optimize_layers,
+                render_workers=render_workers,
+            )
+        except Exception as e:
+            typer.secho(f"Error: {e}", fg=typer.colors.RED, err=True)
+
+    resynth()
+    typer.secho(f"Watching {config_dir()} for changes...", fg=typer.colors.GREEN)
+    for changed in watch_changes(watched_files, interval=interval, debounce=debounce):
+        for path in sorted(changed):
+            typer.echo(f"Changed: {path}")
+        if any(template_dir in path.parents for path in changed):
+            jinja_env().cache.clear()  # Compiled code is still reused if unchanged
+        resynth()
 
 
 @app.command()
-def build(name: str = "default"):
+def build(
+    name: str = "default",
+    jobs: int = typer.Option(
+        None,
+        "--jobs",
+        "-j",
+        min=1,
+        help="Build targets one by one, with up to this many at once, sharing stages.",
+    ),
+    docker: str = typer.Option("docker", help="The docker executable to use."),
+    merge_stages: bool = MERGE_STAGES_OPTION,
+    label_fingerprints: bool = LABEL_FINGERPRINTS_OPTION,
+    optimize_layers: bool = OPTIMIZE_LAYERS_OPTION,
+    image_store: Path = typer.Option(
+        None,
+        help="Skip targets whose fingerprints are recorded in this directory, and "
+        "record the targets that are built.",
+    ),
+):
     """Builds the current configuration from synthesized Dockerfile(s)."""
-    _, build_configs = _synth()
+    import subprocess
+
+    from .cache import SynthManifest
+    from .images import DirectoryImageStore
+    from .models import Module, Target
+    from .scheduler import BakeExecutor, BuildScheduler, mark_up_to_date, plan_jobs
+    from .utils import base_dir, cache_dir
+
+    _synth(
+        merge_stages=merge_stages,
+        label_fingerprints=label_fingerprints,
+        optimize_layers=optimize_layers,
+        record_fingerprints=image_store is not None,
+    )
+    # Re-register modules and targets, whether or not synth already loaded them
+    Module.__modules__.clear()
+    Target.__targets__.clear()
+    targets, build_configs = _load_config()
 
     try:
         config = next(cfg for cfg in build_configs.configs if cfg.name == name)
@@ -87,21 +539,250 @@ def build(name: str = "default"):
             f"Error: No build config found with name '{name}'", fg=typer.colors.RED
         )
         typer.secho(f"Valid names: {names}", fg=typer.colors.YELLOW)
-        typer.Exit(1)
+        raise typer.Exit(1)
+
+    selected = config.select_targets(targets)
+    store = fingerprints = None
+    if image_store is not None:
+        # One store per config, as configs build the same stages with different args
+        store = DirectoryImageStore(image_store / config.name)
+        manifest = SynthManifest.load(cache_dir() / "synth-manifest.json")
+        fingerprints = manifest.fingerprints[config.dockerfile_name]
+
+    if jobs is None:
+        command = config.build_command
+        if store is not None:
+            selected = [t for t in selected if not store.contains(fingerprints[t.name])]
+            if not selected:
+                typer.echo("Every target is up to date")
+                return
+            command += " " + " ".join(t.name for t in selected)
+        typer.echo(command)
+        with profiling.span("docker_build", config=config.name):
+            result = subprocess.run(command, shell=True)
+        if store is not None:
+            if result.returncode != 0:
+                raise typer.Exit(result.returncode)
+            for target in selected:
+                store.add(fingerprints[target.name], target.name)
+        return
+
+    # A pruned Dockerfile names its stages after only the config's own targets
+    plan = targets.plan_stages(
+        selected if config.prune else targets.select(),
+        merge_duplicates=merge_stages,
+        fold_targets=optimize_layers,
+    )
+    build_jobs = plan_jobs(plan, [t.name for t in selected])
+    if store is not None:
+        mark_up_to_date(build_jobs, lambda job: store.contains(fingerprints[job.name]))
+    scheduler = BuildScheduler(
+        build_jobs,
+        BakeExecutor(str(base_dir() / config.bakefile_name), docker=docker),
+        max_workers=jobs,
+        echo=typer.echo,
+    )
+    with profiling.span("docker_build", config=config.name):
+        succeeded = scheduler.run()
+
+    if store is not None:
+        for job in build_jobs:
+            if job.target is not None and job.status == "succeeded":
+                store.add(fingerprints[job.name], job.name)
+
+    typer.secho("\nBuild summary", bold=True)
+    typer.echo(scheduler.summary())
+    if not succeeded:
+        raise typer.Exit(1)
+
+
+@app.command("compile")
+def compile_config():
+    """Compiles the project's config into a snapshot that later commands load quickly."""
+    from .snapshot import ConfigSnapshot, snapshot_path
+
+    targets, build_configs = _parse_config()
+    snapshot = ConfigSnapshot.compile(targets, build_configs)
+    snapshot.save(snapshot_path())
+    typer.echo(
+        f"Compiled {len(snapshot.modules)} modules, {len(targets.__root__)} targets, "
+        f"and {len(build_configs.configs)} build configs to {snapshot_path()}"
+    )
+
+
+@app.command()
+def affected(
+    paths: List[Path] = typer.Argument(None, help="Changed files."),
+    git: str = typer.Option(
+        None,
+        help="Use the files changed in this git revision range instead, "
+        "e.g. origin/main...HEAD.",
+    ),
+    config: str = typer.Option(
+        None, help="Only list targets built with this build config."
+    ),
+    bake_file: Path = typer.Option(
+        None, help="Also write a bake file with a group of just the affected targets."
+    ),
+    group: str = typer.Option("affected", help="Name of the group in --bake-file."),
+):
+    """Lists the targets whose images changes to config files can affect."""
+    import json
+
+    from .affected import (
+        TemplateGraph,
+        affected_targets,
+        git_base_revision,
+        git_changed_files,
+        module_names_by_file,
+        targets_changed_since,
+    )
+    from .cache import ModuleParseCache
+    from .utils import base_dir, builds_source, cache_dir, jinja_env, targets_source
+
+    if git:
+        try:
+            changed = git_changed_files(git, base_dir())
+        except RuntimeError as e:
+            typer.secho(f"Error: {e}", fg=typer.colors.RED, err=True)
+            raise typer.Exit(1)
     else:
-        typer.echo(config.build_command)
-        subprocess.run(config.build_command, shell=True)
+        changed = [path.resolve() for path in paths or []]
+    targets, build_configs = _load_config()
+    selected = targets.select()
+    if config:
+        try:
+            build_config = next(c for c in build_configs.configs if c.name == config)
+        except StopIteration:
+            typer.secho(
+                f"Error: No build config found with name '{config}'",
+                fg=typer.colors.RED,
+            )
+            raise typer.Exit(1)
+        selected = build_config.select_targets(targets)
+
+    # Only targets changed in targets.yml are affected, if the old version is known
+    config_files = [builds_source()]
+    changed_targets = None
+    if git and targets_source().resolve() in changed:
+        changed_targets = targets_changed_since(
+            git_base_revision(git, base_dir()), base_dir()
+        )
+    if changed_targets is None:
+        config_files.append(targets_source())
+
+    parse_cache = ModuleParseCache.load(cache_dir() / "modules.pickle")
+    result = affected_targets(
+        changed,
+        selected,
+        module_names_by_file(parse_cache),
+        TemplateGraph(jinja_env()),
+        config_files,
+        changed_targets,
+    )
+    for target in result:
+        typer.echo(target.name)
+    if bake_file is not None:
+        bake = dict(group={group: dict(targets=[target.name for target in result])})
+        bake_file.write_text(json.dumps(bake, indent=2) + "\n")
+
+
+@app.command("optimize-order")
+def optimize_order(
+    max_count: int = typer.Option(
+        1000, help="How many of the latest commits to learn from."
+    ),
+    since: str = typer.Option(
+        None, help="Only learn from commits since this date, e.g. '6 months ago'."
+    ),
+    write: bool = typer.Option(
+        False, "--write", help="Write the suggested priorities to the module files."
+    ),
+):
+    """Suggests module priorities that put often-changed modules last, from git history."""
+    from .affected import TemplateGraph, module_names_by_file
+    from .cache import ModuleParseCache
+    from .ordering import (
+        git_history,
+        hit_rate,
+        module_history,
+        suggest_order,
+        suggest_priorities,
+        target_chains,
+        write_priority,
+    )
+    from .utils import base_dir, cache_dir, config_dir, jinja_env
+
+    targets, _ = _load_config()
+    selected = targets.select()
+    modules = sorted(
+        {module for target in selected for module in target.all_modules()},
+        key=lambda m: (-m.priority, m.name),
+    )
+    parse_cache = ModuleParseCache.load(cache_dir() / "modules.pickle")
+    files = module_names_by_file(parse_cache)
+    try:
+        commits = git_history(config_dir(), base_dir(), max_count, since)
+    except RuntimeError as e:
+        typer.secho(f"Error: {e}", fg=typer.colors.RED, err=True)
+        raise typer.Exit(1)
+    history = module_history(commits, modules, files, TemplateGraph(jinja_env()))
+    volatility = {
+        module.name: sum(1 for changed in history if module.name in changed)
+        for module in modules
+    }
+
+    order = suggest_order(modules, volatility)
+    priorities = suggest_priorities(order)
+    width = max([len("Module")] + [len(module.name) for module in order])
+    typer.echo(f"{'Module':<{width}}  Changes  Priority")
+    for module in order:
+        priority = str(module.priority)
+        if priorities[module.name] != module.priority:
+            priority += f" -> {priorities[module.name]}"
+        typer.echo(f"{module.name:<{width}}  {volatility[module.name]:>7}  {priority}")
+
+    before = hit_rate(target_chains(selected, modules), history)
+    after = hit_rate(target_chains(selected, order), history)
+    typer.echo(
+        f"Estimated cache hit rate over {len(history)} commit(s) that changed "
+        f"modules: {before:.1%} -> {after:.1%}"
+    )
+
+    changes = {
+        module.name: priorities[module.name]
+        for module in order
+        if priorities[module.name] != module.priority
+    }
+    if write and changes:
+        paths = {name: path for path, name in files.items()}
+        for name, priority in sorted(changes.items()):
+            if config_dir().resolve() not in paths[name].parents:
+                typer.secho(
+                    f"Skipping built-in module '{name}'", fg=typer.colors.YELLOW
+                )
+                continue
+            write_priority(paths[name], priority)
+            typer.echo(f"Set priority of '{name}' to {priority} in {paths[name]}")
 
 
 @app.command()
 def show_config():
     """List the current config files and build targets."""
-    preload_modules()
+    if not _via_daemon("show-config"):
+        _show_config()
+
 
+def _show_config(
+    parse_cache: "ModuleParseCache" = None, load_config: "ConfigLoader" = None
+):
+    from .models import resolve_dependencies
+    from .utils import builds_file, targets_file
+
+    target_configs, build_configs = (load_config or _load_config)(parse_cache)
     target_config_file = targets_file()
     build_config_file = builds_file()
-    target_configs = TargetCollection.parse_obj(yml_load(target_config_file))
-    build_configs = BuildConfigCollection.parse_obj(yml_load(build_config_file))
+    resolve_dependencies(target_configs.targets)
 
     typer.secho("Config files", bold=True, fg=typer.colors.GREEN)
     typer.echo(str(target_config_file))
@@ -119,6 +800,111 @@ def show_config():
         typer.echo(f"{build_config.name} {build_config.image}")
 
 
+@app.command()
+def bakefile(name: str = "default"):
+    """Prints the bake file of a build configuration, without writing anything."""
+    if not _via_daemon("bakefile", name=name):
+        _bakefile(name)
+
+
+def _bakefile(
+    name: str,
+    parse_cache: "ModuleParseCache" = None,
+    load_config: "ConfigLoader" = None,
+):
+    targets, build_configs = (load_config or _load_config)(parse_cache)
+    try:
+        config = next(cfg for cfg in build_configs.configs if cfg.name == name)
+    except StopIteration:
+        typer.secho(
+            f"Error: No build config found with name '{name}'", fg=typer.colors.RED
+        )
+        raise typer.Exit(1)
+    typer.echo(config.generate_bakefile(targets))
+
+
+@app.command()
+def serve():
+    """Keeps the project loaded, answering synth, show-config and bakefile for other
+    docker-printer invocations until interrupted."""
+    import contextlib
+    import io
+    import time
+
+    from .cache import ModuleParseCache, SynthManifest
+    from .daemon import serve as serve_requests
+    from .daemon import socket_path
+    from .models import Module, Target
+    from .utils import cache_dir, config_dir, jinja_env, watched_files
+    from .watch import changed_paths, snapshot
+
+    manifest = SynthManifest.load(cache_dir() / "synth-manifest.json")
+    parse_cache = ModuleParseCache.load(cache_dir() / "modules.pickle")
+    template_dir = config_dir() / "templates"
+    files = snapshot(watched_files())
+    loaded = None  # Targets and build configs, kept until a config file changes
+
+    def load_config(parse_cache: "ModuleParseCache" = None):
+        nonlocal loaded
+        if loaded is None:
+            # Modules and targets are registered afresh, from the in-memory caches
+            Module.__modules__.clear()
+            Target.__targets__.clear()
+            loaded = _load_config(parse_cache)
+        return loaded
+
+    commands = {
+        "synth": lambda args: _synth(
+            manifest=manifest, parse_cache=parse_cache, load_config=load_config, **args
+        ),
+        "show-config": lambda args: _show_config(parse_cache, load_config),
+        "bakefile": lambda args: _bakefile(args["name"], parse_cache, load_config),
+    }
+
+    def handle(command: str, args: dict) -> dict:
+        nonlocal files, loaded
+        start = time.perf_counter()
+        # Files changed since the last request invalidate what was loaded from them
+        latest = snapshot(watched_files())
+        changed = changed_paths(files, latest)
+        if any(template_dir in path.parents for path in changed):
+            jinja_env().cache.clear()  # Compiled code is still reused if unchanged
+        if changed:
+            loaded = None
+        files = latest
+
+        output = io.StringIO()
+        exit_code = 0
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                if command not in commands:
+                    raise ValueError(f"Unknown command '{command}'")
+                commands[command](args)
+            except typer.Exit as e:
+                exit_code = e.exit_code
+            except Exception as e:
+                typer.secho(f"Error: {e}", fg=typer.colors.RED, err=True)
+                exit_code = 1
+        elapsed = time.perf_counter() - start
+        typer.echo(f"{command}: exit {exit_code} in {elapsed * 1000:.1f} ms")
+        return dict(output=output.getvalue(), exit_code=exit_code)
+
+    path = socket_path()
+    try:
+        serve_requests(
+            path,
+            handle,
+            on_ready=lambda: typer.secho(
+                f"Serving {config_dir()} on {path}", fg=typer.colors.GREEN
+            ),
+        )
+    except RuntimeError as e:
+        typer.secho(f"Error: {e}", fg=typer.colors.RED, err=True)
+        raise typer.Exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
 @app.command()
 def init(
     path: Path = typer.Argument(
@@ -145,6 +931,7 @@ def init(
         textwrap.dedent(
             """
             *.rendered.yml
-            """.lstrip()
-        )
+            .cache/
+            """
+        ).lstrip()
     )
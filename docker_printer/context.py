@@ -0,0 +1,224 @@
+"""The files a Dockerfile reads from its build context, and `.dockerignore` files that
+send only those."""
+
+import json
+import os
+import posixpath
+import re
+import shlex
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from .dockerfile import instructions
+
+IGNORE_HEADER = "# Generated by docker-printer from the files {name} uses; do not edit"
+
+
+class ContextError(ValueError):
+    """A Dockerfile reads files from its context that can't be listed ahead of time"""
+
+
+def _split(args: str) -> List[str]:
+    try:
+        return shlex.split(args)
+    except ValueError:
+        return args.split()
+
+
+def _arguments(args: str) -> Tuple[List[str], List[str]]:
+    """An instruction's leading flags, and its other arguments in exec or shell form"""
+    flags = []
+    while args.startswith("--"):
+        flag, _, args = args.partition(" ")
+        flags.append(flag)
+        args = args.lstrip()
+    if args.startswith("["):
+        try:
+            return flags, json.loads(args)
+        except ValueError:
+            pass
+    return flags, _split(args)
+
+
+def _context_path(source: str, instruction: str) -> str:
+    if "$" in source:
+        raise ContextError(f"{instruction} source '{source}' uses a variable")
+    path = posixpath.normpath(source.lstrip("/")) if source.lstrip("/") else "."
+    if path == ".":
+        raise ContextError(f"{instruction} copies the whole build context")
+    if path == ".." or path.startswith("../"):
+        raise ContextError(f"{instruction} source '{source}' is outside the context")
+    return path
+
+
+def _mount_sources(flag: str) -> List[str]:
+    """The context path a `RUN --mount` flag binds, if it binds one"""
+    options = dict(
+        option.partition("=")[::2] for option in flag[len("--mount=") :].split(",")
+    )
+    if options.get("type", "bind") != "bind" or "from" in options:
+        return []
+    return [options.get("source", options.get("src", "."))]
+
+
+def context_sources(dockerfile: str) -> List[str]:
+    """The paths (or patterns) below the build context that `dockerfile` reads, from
+    its `COPY` and `ADD` instructions and `RUN --mount` binds
+
+    Raises ContextError if a source uses a variable or is the whole context, as the
+    context can't be narrowed then.
+    """
+    sources = set()
+    for instruction, args, _ in instructions(dockerfile):
+        if instruction not in ("COPY", "ADD", "RUN"):
+            continue
+        flags, words = _arguments(args)
+        if instruction == "RUN":
+            for flag in flags:
+                if flag.startswith("--mount="):
+                    for source in _mount_sources(flag):
+                        sources.add(_context_path(source, "RUN --mount"))
+            continue
+        if any(flag.startswith("--from=") for flag in flags):
+            continue
+        for source in words[:-1]:
+            if source.startswith("<<"):
+                continue
+            if instruction == "ADD" and ("://" in source or source.startswith("git@")):
+                continue
+            sources.add(_context_path(source, instruction))
+    return sorted(sources)
+
+
+def dockerignore_lines(
+    name: str, sources: List[str], exclusions: List[str] = ()
+) -> List[str]:
+    """An ignore file that excludes everything but `sources`, then `exclusions`"""
+    lines = [IGNORE_HEADER.format(name=name), "*"]
+    lines.extend(f"!{source}" for source in sources)
+    lines.extend(exclusions)
+    return [f"{line}\n" for line in lines]
+
+
+def is_generated(path: Path) -> bool:
+    try:
+        with open(path) as f:
+            return f.readline().startswith(IGNORE_HEADER.split("{")[0])
+    except OSError:
+        return False
+
+
+def read_patterns(path: Path) -> List[str]:
+    """The patterns in a `.dockerignore` file, or none if it doesn't exist"""
+    try:
+        lines = path.read_text().splitlines()
+    except OSError:
+        return []
+    return [line.strip() for line in lines if line.strip() and line[0] != "#"]
+
+
+def _translate(pattern: str) -> str:
+    """A regex for a `.dockerignore` pattern, as Docker's pattern matcher reads it"""
+    regex, i = "", 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex, i = regex + "(?:.*/)?", i + 3
+            continue
+        if pattern.startswith("**", i):
+            regex, i = regex + ".*", i + 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                regex += pattern[i : end + 1].replace("[!", "[^", 1)
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+class _Pattern(NamedTuple):
+    regex: "re.Pattern"
+    parts: List[str]
+    exclusion: bool
+
+    @classmethod
+    def parse(cls, pattern: str) -> Optional["_Pattern"]:
+        exclusion = pattern.startswith("!")
+        pattern = posixpath.normpath(pattern.lstrip("!").strip().lstrip("/"))
+        if pattern == ".":
+            return None
+        return cls(re.compile(_translate(pattern)), pattern.split("/"), exclusion)
+
+    def matches(self, parts: List[str]) -> bool:
+        """Whether the path, or any directory it's in, matches"""
+        return any(
+            self.regex.fullmatch("/".join(parts[:depth]))
+            for depth in range(1, len(parts) + 1)
+        )
+
+    def may_match_below(self, parts: List[str]) -> bool:
+        """Whether the pattern could match something inside directory `parts`"""
+        for part, pattern in zip(parts, self.parts):
+            if "**" in pattern:
+                return True
+            if not re.fullmatch(_translate(pattern), part):
+                return False
+        return True
+
+
+class ContextSize(NamedTuple):
+    files: int
+    bytes: int
+
+    def __str__(self):
+        size = float(self.bytes)
+        for unit in ("B", "kB", "MB", "GB"):
+            if size < 1000 or unit == "GB":
+                break
+            size /= 1000
+        amount = f"{self.bytes} B" if unit == "B" else f"{size:.1f} {unit}"
+        return f"{amount} in {self.files} file{'' if self.files == 1 else 's'}"
+
+
+def context_size(root: Path, patterns: List[str] = ()) -> ContextSize:
+    """How much of `root` is sent as build context, given ignore `patterns`
+
+    Excluded directories are not walked unless an exception pattern could re-include
+    something inside them.
+    """
+    parsed = [p for p in map(_Pattern.parse, patterns) if p is not None]
+    exceptions = [p for p in parsed if p.exclusion]
+
+    def excluded(parts: List[str]) -> bool:
+        result = False
+        for pattern in parsed:
+            if pattern.matches(parts):
+                result = not pattern.exclusion
+        return result
+
+    files = size = 0
+    for dirpath, dirnames, filenames in os.walk(str(root)):
+        relative = Path(dirpath).relative_to(root).parts
+        kept = []
+        for dirname in dirnames:
+            parts = [*relative, dirname]
+            if not excluded(parts) or any(p.may_match_below(parts) for p in exceptions):
+                kept.append(dirname)
+        dirnames[:] = kept
+        for filename in filenames:
+            if not excluded([*relative, filename]):
+                files += 1
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return ContextSize(files, size)
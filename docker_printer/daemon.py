@@ -0,0 +1,98 @@
+"""A long-lived process that answers CLI requests over a Unix socket, and its client.
+
+Requests and responses are single lines of JSON. A request names a `command` and
+its `args`, and carries the client's version; a response holds the command's
+`output` and `exit_code`. Clients fall back to doing the work themselves whenever
+no daemon answers, so this module avoids importing anything heavy.
+"""
+
+import json
+import os
+import socket
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from . import __version__
+
+SOCKET_NAME = "daemon.sock"
+DISABLE_VARIABLE = "DOCKER_PRINTER_NO_DAEMON"
+
+Handler = Callable[[str, Dict[str, Any]], Dict[str, Any]]
+
+
+def socket_path(start: Optional[Path] = None) -> Optional[Path]:
+    """Where the daemon for the project around `start` listens, if there is a project
+
+    This mirrors `utils.base_dir`, which can't be imported without pydantic and jinja2.
+    """
+    root = (start or Path()).resolve()
+    while not (root / "docker-printer").is_dir():
+        if root == root.parent:
+            return None
+        root = root.parent
+    return root / "docker-printer" / ".cache" / SOCKET_NAME
+
+
+def request(command: str, **args) -> Optional[Dict[str, Any]]:
+    """Sends a request to the running daemon, or returns None if none is available"""
+    if os.environ.get(DISABLE_VARIABLE):
+        return None
+    path = socket_path()
+    if path is None or not path.exists():
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(str(path))
+            sock.settimeout(None)  # Synthesizing a large project can take a while
+            message = dict(command=command, args=args, version=__version__)
+            sock.sendall(json.dumps(message).encode() + b"\n")
+            with sock.makefile("rb") as f:
+                line = f.readline()
+    except OSError:  # Not running (or a stale socket), so work in-process
+        return None
+    if not line:
+        return None
+
+    response = json.loads(line)
+    if response.get("error") == "version":
+        return None
+    return response
+
+
+def serve(path: Path, handle: Handler, on_ready: Callable[[], None] = None):
+    """Answers requests on `path` one at a time until interrupted"""
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message.get("version") != __version__:
+                # A different docker-printer version would synthesize differently
+                response = dict(error="version", version=__version__)
+            else:
+                response = handle(message["command"], message.get("args", {}))
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    if path.exists():
+        # Only replace the socket if nothing is listening on it any more
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(path))
+            except OSError:
+                path.unlink()
+            else:
+                raise RuntimeError(f"A daemon is already listening on {path}")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with socketserver.UnixStreamServer(str(path), RequestHandler) as server:
+        try:
+            if on_ready is not None:
+                on_ready()
+            server.serve_forever()
+        finally:
+            path.unlink()
@@ -0,0 +1,64 @@
+"""Splitting rendered Dockerfile text into instructions, keeping their original lines."""
+
+import re
+from typing import List, NamedTuple, Optional, Union
+
+_heredoc = re.compile(r"<<-?(['\"]?)([A-Za-z_][A-Za-z0-9_]*)\1")
+_from_line = re.compile(
+    r"^[ \t]*FROM[ \t]+((?:[^\n]*\\\n)*[^\n]*)$", re.IGNORECASE | re.MULTILINE
+)
+
+
+class Instruction(NamedTuple):
+    keyword: str  # Upper case
+    args: str  # Continuation lines joined, without comments or heredoc bodies
+    lines: List[str]  # As written, including continuation lines and heredoc bodies
+
+
+def parse(text: str) -> List[Union[Instruction, str]]:
+    """The instructions in `text`, with the blank and comment lines between them as
+    plain strings
+    """
+    items: List[Union[Instruction, str]] = []
+    lines = iter(text.splitlines())
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            items.append(line)
+            continue
+        written = [line]
+        while stripped.endswith("\\"):
+            stripped = stripped[:-1]
+            for line in lines:
+                written.append(line)
+                if line.strip() and not line.strip().startswith("#"):
+                    stripped += " " + line.strip()
+                    break
+            else:
+                break
+        keyword, _, args = stripped.partition(" ")
+        for match in _heredoc.finditer(args):
+            for line in lines:
+                written.append(line)
+                if line.strip() == match.group(2):
+                    break
+        items.append(Instruction(keyword.upper(), args.strip(), written))
+    return items
+
+
+def instructions(text: str) -> List[Instruction]:
+    return [item for item in parse(text) if isinstance(item, Instruction)]
+
+
+def from_line(text: str) -> Optional["re.Match"]:
+    """The first `FROM` instruction in `text`, with its arguments as group 1"""
+    return _from_line.search(text)
+
+
+def base_image(text: str) -> Optional[str]:
+    """The image or stage the first `FROM` in `text` builds on"""
+    match = from_line(text)
+    if match is None:
+        return None
+    words = [word for word in match.group(1).split() if word[:2] != "--"]
+    return words[0] if words else None
@@ -0,0 +1,123 @@
+"""Transitive closures over named dependency graphs, such as `depends_on` and `extends`."""
+
+from typing import Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple
+
+
+class DependencyError(RuntimeError):
+    """Raised with every missing reference and cycle found while resolving dependencies"""
+
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        super().__init__(
+            "Invalid dependencies:\n" + "\n".join(f"  - {p}" for p in problems)
+        )
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """Yields the index of every set bit in `mask`, lowest first"""
+    # Scanning the binary string is linear in the mask's width, where repeatedly
+    # clearing the lowest bit of a large int would be quadratic
+    bits = bin(mask)[:1:-1]
+    i = bits.find("1")
+    while i != -1:
+        yield i
+        i = bits.find("1", i + 1)
+
+
+class DependencyGraph:
+    """Closures of every node reachable from a set of roots, found in one O(V+E) pass
+
+    Each closure is stored as an integer bitset, so unions are cheap and closures stay
+    compact. Bits follow `ordering` when it's given, so decoding a closure yields its
+    members already in that order; otherwise nodes are numbered as they're discovered.
+    """
+
+    def __init__(
+        self, edges: Mapping[str, Sequence[str]], ordering: Sequence[str] = None
+    ):
+        self.edges = edges
+        self.nodes: List[str] = list(ordering) if ordering is not None else []
+        self.bits: Dict[str, int] = {node: i for i, node in enumerate(self.nodes)}
+        self.index: Dict[str, int] = {}
+        self.closures: Dict[str, int] = {}
+        # Nodes in an order where every node comes after everything it depends on
+        self.order: List[str] = []
+        self.cycles: List[List[str]] = []
+        self.missing: List[Tuple[str, str]] = []
+
+    def resolve(self, roots: Iterable[str]) -> "DependencyGraph":
+        """Computes closures for `roots` and everything they reach (Tarjan's SCC algorithm)"""
+        edges = self.edges
+        index = self.index
+        lowlink: Dict[str, int] = {}
+        stack: List[str] = []
+        on_stack = set()
+
+        for root in roots:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = lowlink[node] = len(index)
+                    if node not in self.bits:
+                        self.bits[node] = len(self.nodes)
+                        self.nodes.append(node)
+                    stack.append(node)
+                    on_stack.add(node)
+
+                deps = edges[node]
+                descended = False
+                while i < len(deps):
+                    dep = deps[i]
+                    i += 1
+                    if dep not in edges:
+                        self.missing.append((node, dep))
+                    elif dep not in index:
+                        work.append((node, i))
+                        work.append((dep, 0))
+                        descended = True
+                        break
+                    elif dep in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dep])
+                if descended:
+                    continue
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    self._close(component)
+
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+        return self
+
+    def _close(self, component: List[str]):
+        # Components are completed dependencies-first, so every dependency outside this
+        # component already has its closure
+        mask = 0
+        for member in component:
+            mask |= 1 << self.bits[member]
+        for member in component:
+            for dep in self.edges[member]:
+                closure = self.closures.get(dep)
+                if closure is not None:
+                    mask |= closure
+        for member in reversed(component):
+            self.closures[member] = mask
+            self.order.append(member)
+
+        if len(component) > 1 or component[0] in self.edges[component[0]]:
+            self.cycles.append(sorted(component, key=self.index.__getitem__))
+
+    def decode(self, mask: int) -> List[str]:
+        nodes = self.nodes
+        return [nodes[i] for i in iter_bits(mask)]
@@ -0,0 +1,39 @@
+"""Where built images are recorded by stage fingerprint, so `build` can skip them."""
+
+import json
+import os
+import time
+from pathlib import Path
+
+
+class ImageStore:
+    """Images that were already built and published, by fingerprint; subclasses
+    decide where to look
+    """
+
+    def contains(self, fingerprint: str) -> bool:
+        raise NotImplementedError
+
+    def add(self, fingerprint: str, target: str):
+        """Records that `target` was built with `fingerprint`"""
+        raise NotImplementedError
+
+
+class DirectoryImageStore(ImageStore):
+    """A local stand-in for a registry: one small file per fingerprint in a directory"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def _entry(self, fingerprint: str) -> Path:
+        return self.path / f"{fingerprint}.json"
+
+    def contains(self, fingerprint: str) -> bool:
+        return self._entry(fingerprint).exists()
+
+    def add(self, fingerprint: str, target: str):
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = self._entry(fingerprint)
+        tmp_path = entry.with_name(entry.name + ".tmp")
+        tmp_path.write_text(json.dumps(dict(target=target, built=time.time())))
+        os.replace(tmp_path, entry)
@@ -0,0 +1,211 @@
+"""Consolidating the instructions of rendered stages into fewer layers and steps.
+
+Only rewrites that leave the final images the same are made: consecutive `RUN`s are
+merged with `&&` unless an earlier one changes shell state or a later one isn't a
+single `&&` chain (or a `SHELL` is in effect, here or in a stage it's built on),
+consecutive `ENV`s and `LABEL`s are combined unless a value refers to a variable set
+in the same group, and settings a stage inherits unchanged from the stage it's built on
+are dropped.
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from .dockerfile import Instruction, parse
+
+# Builtins whose effects outlast their command, so nothing may be merged after them
+_stateful = re.compile(
+    r"(?:^|[;&|(]|\b(?:then|do|else)\b)\s*"
+    r"(?:cd|pushd|popd|export|set|unset|source|\.|alias|umask|shopt|ulimit|trap|"
+    r"exec|exit|return|eval|declare|readonly|local|shift)(?=[\s;]|$)"
+)
+# Operators that would bind a later command's failure differently once it's chained
+_list_operator = re.compile(r";|\|\||(?<!&)&(?!&)")
+_pair = re.compile(
+    r"""\s*((?:"(?:[^"\\]|\\.)*"|[^\s="\\])+)"""
+    r"""=((?:"(?:[^"\\]|\\.)*"|'[^']*'|\\.|[^\s"'\\])*)(?=\s|$)"""
+)
+
+Settings = Dict[str, str]
+
+
+class LayerSavings:
+    """How many layers and instructions optimizing a stage removed"""
+
+    def __init__(
+        self, base: Optional[str] = None, layers: int = 0, instructions: int = 0
+    ):
+        self.base = base
+        self.layers = layers
+        self.instructions = instructions
+
+
+class StageSettings:
+    """What a stage leaves set for the stages built on it"""
+
+    def __init__(
+        self,
+        env: Optional[Settings] = None,
+        labels: Optional[Settings] = None,
+        custom_shell: bool = False,
+    ):
+        self.env = dict(env or {})
+        self.labels = dict(labels or {})
+        self.custom_shell = custom_shell
+
+    def copy(self) -> "StageSettings":
+        return StageSettings(self.env, self.labels, self.custom_shell)
+
+
+def _pairs(args: str) -> Optional[List[Tuple[str, str]]]:
+    """The `key=value` pairs of an `ENV` or `LABEL`, or None if written otherwise"""
+    pairs = []
+    position = 0
+    while position < len(args):
+        match = _pair.match(args, position)
+        if match is None:
+            return None
+        pairs.append((match.group(1), match.group(2)))
+        position = match.end()
+    return pairs or None
+
+
+def _unquote(key: str) -> str:
+    return key[1:-1] if len(key) > 1 and key[0] == key[-1] == '"' else key
+
+
+def _refers_to(value: str, names: Iterable[str]) -> bool:
+    return any(re.search(rf"\${{?{re.escape(name)}\b", value) for name in names)
+
+
+def _mergeable_run(instruction: Instruction) -> bool:
+    args = instruction.args
+    return not (
+        args.startswith(("[", "--"))
+        or "<<" in args
+        or "#" in args
+        or args.rstrip().endswith((";", "&", "|", "\\"))
+    )
+
+
+def _merge_runs(first: Instruction, second: Instruction) -> Instruction:
+    lines = [*first.lines[:-1], first.lines[-1].rstrip() + " && \\"]
+    rest = re.sub(r"^\s*\S+\s*", "", second.lines[0], count=1)
+    if rest.strip() not in ("", "\\"):
+        lines.append("    " + rest)
+    lines.extend(second.lines[1:])
+    return Instruction("RUN", f"{first.args} && {second.args}", lines)
+
+
+def _settings_instruction(keyword: str, pairs: List[Tuple[str, str]]) -> Instruction:
+    text = " \\\n    ".join(f"{key}={value}" for key, value in pairs)
+    args = " ".join(f"{key}={value}" for key, value in pairs)
+    return Instruction(keyword, args, f"{keyword} {text}".split("\n"))
+
+
+def optimize_chunk(chunk: str, settings: StageSettings) -> Tuple[str, LayerSavings]:
+    """Consolidates a stage's instructions, given the `settings` it inherits
+
+    `settings` is updated in place to what the stage leaves set.
+    """
+    savings = LayerSavings()
+    out: List[Union[Instruction, str]] = []
+    last = None  # Index in `out` of the last instruction
+    pairs_of: Dict[int, List[Tuple[str, str]]] = {}
+    env, labels = settings.env, settings.labels
+
+    def replace_last(instruction: Instruction):
+        # Comments between merged instructions move above them; blank lines go
+        nonlocal last
+        comments = [line for line in out[last + 1 :] if line.strip()]
+        out[last:] = [*comments, instruction]
+        pairs_of[len(out) - 1] = pairs_of.pop(last, None)
+        last = len(out) - 1
+
+    for item in parse(chunk):
+        if not isinstance(item, Instruction):
+            out.append(item)
+            continue
+        previous = out[last] if last is not None else None
+
+        if item.keyword == "FROM" and last is not None:
+            env.clear()  # Another stage, built on something unknown
+            labels.clear()
+            settings.custom_shell = False
+        elif item.keyword == "SHELL":
+            settings.custom_shell = True
+
+        elif item.keyword == "RUN":
+            if (
+                not settings.custom_shell
+                and previous is not None
+                and previous.keyword == "RUN"
+                and _mergeable_run(previous)
+                and _mergeable_run(item)
+                and not _stateful.search(previous.args)
+                and not _list_operator.search(item.args)
+            ):
+                replace_last(_merge_runs(previous, item))
+                savings.layers += 1
+                savings.instructions += 1
+                continue
+
+        elif item.keyword in ("ENV", "LABEL"):
+            current = env if item.keyword == "ENV" else labels
+            pairs = _pairs(item.args)
+            if pairs is None:
+                current.clear()  # Can't tell what it sets
+            else:
+                kept = [
+                    (key, value)
+                    for key, value in pairs
+                    if "$" in value or current.get(_unquote(key)) != value
+                ]
+                current.update((_unquote(key), value) for key, value in pairs)
+                if not kept:
+                    savings.instructions += 1
+                    continue
+                group = pairs_of.get(last) if previous is not None else None
+                if group is not None and previous.keyword == item.keyword:
+                    keys = [_unquote(key) for key, _ in group]
+                    if item.keyword == "LABEL" or not any(
+                        _refers_to(value, keys) for _, value in kept
+                    ):
+                        replace_last(_settings_instruction(item.keyword, group + kept))
+                        pairs_of[last] = group + kept
+                        savings.instructions += 1
+                        continue
+                if kept != pairs:
+                    item = _settings_instruction(item.keyword, kept)
+                out.append(item)
+                last = len(out) - 1
+                pairs_of[last] = kept
+                continue
+
+        out.append(item)
+        last = len(out) - 1
+
+    lines = []
+    for item in out:
+        lines.extend(item.lines if isinstance(item, Instruction) else [item])
+    text = "\n".join(lines)
+    return (text + "\n" if chunk.endswith("\n") else text), savings
+
+
+def savings_by_target(
+    savings: Dict[str, LayerSavings], targets: Iterable[str]
+) -> Dict[str, Tuple[int, int]]:
+    """Layers and instructions removed from each target's image, over its whole chain
+    of stages
+    """
+    totals = {}
+    for target in targets:
+        layers = instructions = 0
+        name, seen = target, set()
+        while name in savings and name not in seen:
+            seen.add(name)
+            layers += savings[name].layers
+            instructions += savings[name].instructions
+            name = savings[name].base
+        totals[target] = (layers, instructions)
+    return totals
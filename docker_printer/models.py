@@ -1,50 +1,103 @@
+import contextlib
+import hashlib
 import json
 import re
-from collections import defaultdict
-from typing import Any, Dict, Hashable, Iterable, List, Optional, Set, Union
+import sys
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    AbstractSet,
+    Any,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import jinja2
 from pydantic import BaseModel, PrivateAttr, validator
 from rich import print
 from rich.tree import Tree
 
+from . import profiling
+from .graph import DependencyError, DependencyGraph, iter_bits
+from .output import collapse_blank_lines
+
+if TYPE_CHECKING:
+    from .cache import ChunkCache
+    from .layers import LayerSavings
+
 
 class CommonListTree:
     class Node:
-        def __init__(self):
-            self.children = defaultdict(CommonListTree.Node)
-            self.labels = set()
-            # self.parent: CommonListTree.Node = None
-
-        def merge_list(self, vals: List[Hashable], label: str):
-            self.labels.add(label)
-            if not vals:
-                return
+        __slots__ = ("children", "labels", "_terminal_labels")
 
-            v, *remaining = vals
-            child = self.children[v]
-            # child.parent = self
-            child.merge_list(remaining, label)
+        def __init__(self):
+            self.children: Dict[Hashable, CommonListTree.Node] = {}
+            self.labels: Set[str] = set()
+            self._terminal_labels: Optional[AbstractSet[str]] = None
+
+        def merge_list(self, vals: Iterable[Hashable], label: str):
+            # Labels are repeated on every node along a list's path, so share one copy
+            label = sys.intern(label)
+            node = self
+            node.labels.add(label)
+            node._terminal_labels = None
+            for v in vals:
+                child = node.children.get(v)
+                if child is None:
+                    child = node.children[v] = CommonListTree.Node()
+                child.labels.add(label)
+                child._terminal_labels = None
+                node = child
 
         @property
-        def terminal_labels(self):
-            return set(self.labels) - {
-                lbl for child in self.children.values() for lbl in child.labels
-            }
+        def terminal_labels(self) -> AbstractSet[str]:
+            # Only nodes along a newly merged path are invalidated, so this is
+            # computed once per node after the tree is built
+            if self._terminal_labels is None:
+                if self.children:
+                    self._terminal_labels = frozenset(
+                        self.labels.difference(
+                            *(child.labels for child in self.children.values())
+                        )
+                    )
+                else:
+                    self._terminal_labels = self.labels
+            return self._terminal_labels
 
         def tree(self, tree=None) -> Tree:
-            for value, child in self.children.items():
+            subtrees = {self: tree}
+
+            def add_subtree(value, child, parent):
                 terminals = " ".join(
                     f"[code]{lbl}[/code]" for lbl in child.terminal_labels
                 )
                 text = f"{value} {terminals}"
-                subtree = tree.add(text.strip())
-                child.tree(subtree)
+                subtrees[child] = subtrees[parent].add(text.strip())
+
+            self.visit(add_subtree)
 
         def visit(self, func):
-            for value, child in self.children.items():
-                func(value, child, self)
-                child.visit(func)
+            # Depth-first in insertion order, iteratively so deep chains can't hit the
+            # recursion limit
+            stack = [(value, child, self) for value, child in self.children.items()]
+            stack.reverse()
+            while stack:
+                value, node, parent = stack.pop()
+                func(value, node, parent)
+                if node.children:
+                    children = [(v, child, node) for v, child in node.children.items()]
+                    children.reverse()
+                    stack.extend(children)
 
     def __init__(self):
         self.root = CommonListTree.Node()
@@ -52,8 +105,8 @@ class CommonListTree:
     def merge_list(self, *args, **kwargs):
         self.root.merge_list(*args, **kwargs)
 
-    def tree(self) -> Tree:
-        root = Tree("[dim]Dockerfile.synth[/dim]")
+    def tree(self, title: str = "Dockerfile.synth") -> Tree:
+        root = Tree(f"[dim]{title}[/dim]")
         self.root.tree(root)
         return root
 
@@ -61,6 +114,69 @@ class CommonListTree:
         self.root.visit(func)
 
 
+class Registry:
+    """Everything loaded for one project: its modules and targets by name, its
+    directory, and its Jinja environment
+
+    The CLI works with a default registry. Activating another one, as `Project` does,
+    gives the current thread or task its own modules and targets, so several projects
+    can be loaded and synthesized in one process.
+    """
+
+    def __init__(self, base_dir: Optional[Path] = None):
+        self.modules: Dict[str, Module] = {}
+        self.targets: Dict[str, Target] = {}
+        # Found from the working directory when None
+        self.base_dir = base_dir
+        # Created from the project's templates on first use when None
+        self.environment: Optional[jinja2.Environment] = None
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator["Registry"]:
+        token = _active_registry.set(self)
+        try:
+            yield self
+        finally:
+            _active_registry.reset(token)
+
+
+_active_registry: ContextVar[Registry] = ContextVar(
+    "docker_printer_registry", default=Registry()
+)
+
+
+def active_registry() -> Registry:
+    return _active_registry.get()
+
+
+class _ActiveRegistryView(MutableMapping):
+    """`Module.__modules__` and `Target.__targets__`, as seen by the active registry"""
+
+    def __init__(self, attribute: str):
+        self._attribute = attribute
+
+    def _items(self) -> dict:
+        return getattr(_active_registry.get(), self._attribute)
+
+    def __getitem__(self, key):
+        return self._items()[key]
+
+    def __setitem__(self, key, value):
+        self._items()[key] = value
+
+    def __delitem__(self, key):
+        del self._items()[key]
+
+    def __contains__(self, key):
+        return key in self._items()
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __len__(self):
+        return len(self._items())
+
+
 class FilledTemplate(BaseModel):
     file: str = "stage.Dockerfile.jinja2"
     variables: Dict[str, Any] = {}
@@ -70,7 +186,7 @@ class FilledTemplate(BaseModel):
 
 
 class Module(BaseModel):
-    __modules__: Dict[str, "Module"] = dict()
+    __modules__: Dict[str, "Module"] = _ActiveRegistryView("modules")
 
     name: str
     depends_on: List[str] = []
@@ -79,9 +195,14 @@ class Module(BaseModel):
     image_args: Dict[str, Any] = {}
 
     _all_modules: Set["Module"] = PrivateAttr(default=None)
+    _closure: Tuple[int, List["Module"]] = PrivateAttr(default=None)
 
-    def __init__(self, **kwargs):
+    def __init__(self, register: bool = True, **kwargs):
         super().__init__(**kwargs)
+        if register:
+            self.register()
+
+    def register(self):
         if self.name in self.__modules__:
             raise RuntimeError(
                 f"Multiple modules defined with the same name: '{self.name}'"
@@ -100,11 +221,14 @@ class Module(BaseModel):
 
     def all_modules(self) -> Set["Module"]:
         if self._all_modules is None:
-            self._all_modules = {self} | {
-                mod
-                for dep in self.depends_on
-                for mod in Module.__modules__[dep].all_modules()
-            }
+            if self._closure is None:
+                problems = []
+                graph = _resolve_modules([self.name], problems)
+                if problems:
+                    raise DependencyError(problems)
+                _assign_module_closures(graph)
+            mask, modules = self._closure
+            self._all_modules = {modules[i] for i in iter_bits(mask)}
         return self._all_modules
 
     def get_chunk(self, environment: jinja2.Environment, prev_name, cur_name):
@@ -114,7 +238,10 @@ class Module(BaseModel):
         vars.setdefault("labels", {})
         vars.setdefault("arguments", {})
         vars.setdefault("env", {})
-        return environment.get_template(self.template.file).render(**vars)
+        with profiling.span(
+            cur_name, "chunk", module=self.name, template=self.template.file
+        ):
+            return environment.get_template(self.template.file).render(**vars)
 
     def __repr__(self):
         return f"<{type(self).__name__} {self.name}>"
@@ -124,7 +251,7 @@ class Module(BaseModel):
 
 
 class Target(BaseModel):
-    __targets__: Dict[str, "Target"] = {}
+    __targets__: Dict[str, "Target"] = _ActiveRegistryView("targets")
 
     name: str
     modules: List[str] = set()
@@ -133,6 +260,7 @@ class Target(BaseModel):
     tags: List[str] = []
 
     _all_modules: List[Module] = PrivateAttr(default=None)
+    _closure: Tuple[int, List["Target"]] = PrivateAttr(default=None)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -151,46 +279,34 @@ class Target(BaseModel):
 
     @property
     def _extended_targets(self) -> Set["Target"]:
-        return {
-            target
-            for extended_target in self.extends
-            for target in Target.__targets__[extended_target].all_targets()
-        }
+        return self.all_targets() - {self}
 
-    def all_targets(self):
-        return {self} | self._extended_targets
+    def all_targets(self) -> Set["Target"]:
+        if self._closure is None:
+            resolve_dependencies([self])
+        mask, targets = self._closure
+        return {targets[i] for i in iter_bits(mask)}
 
     def all_modules(self) -> Iterable[Module]:
         if self._all_modules is None:
-            modules = {
-                mod
-                for base_mod in self._resolved_modules
-                for mod in base_mod.all_modules()
-            } | {
-                mod for target in self._extended_targets for mod in target.all_modules()
-            }
-            self._all_modules = list(
-                sorted(modules, key=lambda m: (-m.priority, m.name))
-            )
-
+            resolve_dependencies([self])
         return self._all_modules
 
-    def render_dockerfile(self, environment: jinja2.Environment):
+    def iter_dockerfile(self, environment: jinja2.Environment) -> Iterator[str]:
         image_args = {}
         for mod in self._resolved_modules:
             image_args.update(mod.image_args)
 
-        prev_mod = None
-        chunks = []
+        stages = []
+        prev_name = None
         for mod in self.all_modules():
-            chunks.append(mod.get_chunk(environment, prev_mod.name, mod.name))
-            prev_mod = mod
+            stages.append(Stage(mod, prev_name, mod.name))
+            prev_name = mod.name
 
-        dockerfile = environment.get_template("base.Dockerfile.jinja2").render(
-            image_arguments=image_args, chunks=chunks
-        )
-        dockerfile = re.sub(r"\n{3,}", r"\n\n", dockerfile)
-        return dockerfile
+        return _iter_dockerfile(environment, image_args, stages)
+
+    def render_dockerfile(self, environment: jinja2.Environment) -> str:
+        return "".join(self.iter_dockerfile(environment))
 
     def __repr__(self):
         return f"<{type(self).__name__} {self.name}>"
@@ -199,6 +315,448 @@ class Target(BaseModel):
         return self.name
 
 
+def _resolve_modules(names: Iterable[str], problems: List[str]) -> DependencyGraph:
+    registered = active_registry().modules
+    # Number modules in build order, so decoded closures come out already sorted
+    ordering = sorted(registered.values(), key=lambda m: (-m.priority, m.name))
+    graph = DependencyGraph(
+        {name: module.depends_on for name, module in registered.items()},
+        ordering=[module.name for module in ordering],
+    ).resolve(names)
+    problems.extend(
+        f"Module '{name}' depends on unknown module '{ref}'"
+        for name, ref in graph.missing
+    )
+    problems.extend(
+        f"Modules depend on each other in a cycle: {', '.join(cycle)}"
+        for cycle in graph.cycles
+    )
+    return graph
+
+
+def _assign_module_closures(graph: DependencyGraph):
+    registered = active_registry().modules
+    modules = [registered[name] for name in graph.nodes]
+    for name, mask in graph.closures.items():
+        registered[name]._closure = (mask, modules)
+
+
+def resolve_dependencies(targets: Iterable[Target]):
+    """Resolves the closures of `targets` and of every target and module they reach
+
+    Each closure is computed once, in a single pass over the `extends` and `depends_on`
+    graphs. Every unknown reference and cycle is reported together in one
+    `DependencyError`.
+    """
+    registry = active_registry()
+    problems = []
+    target_graph = DependencyGraph(
+        {name: target.extends for name, target in registry.targets.items()}
+    ).resolve(target.name for target in targets)
+    problems.extend(
+        f"Target '{name}' extends unknown target '{ref}'"
+        for name, ref in target_graph.missing
+    )
+    problems.extend(
+        f"Targets extend each other in a cycle: {', '.join(cycle)}"
+        for cycle in target_graph.cycles
+    )
+
+    reached = [registry.targets[name] for name in target_graph.order]
+    module_names = []
+    for target in reached:
+        for name in target.modules:
+            if name in registry.modules:
+                module_names.append(name)
+            else:
+                problems.append(f"Target '{target.name}' uses unknown module '{name}'")
+    module_graph = _resolve_modules(module_names, problems)
+
+    if problems:
+        raise DependencyError(problems)
+
+    _assign_module_closures(module_graph)
+    modules = [registry.modules[name] for name in module_graph.nodes]
+    targets_by_index = [registry.targets[name] for name in target_graph.nodes]
+    module_masks: Dict[str, int] = {}
+    for target in reached:  # Extended targets always come before their extenders
+        mask = 0
+        for name in target.modules:
+            mask |= module_graph.closures[name]
+        for name in target.extends:
+            mask |= module_masks[name]
+        module_masks[target.name] = mask
+        target._closure = (target_graph.closures[target.name], targets_by_index)
+        target._all_modules = [modules[i] for i in iter_bits(mask)]
+
+
+class Stage(NamedTuple):
+    """A single `FROM <base> AS <name>` stage, or a bare target stage if `module` is None"""
+
+    module: Optional[Module]
+    base: Optional[str]
+    name: str
+
+
+class StagePlan:
+    """Named stages for a set of targets, in Dockerfile order"""
+
+    def __init__(self, tree: CommonListTree):
+        self.tree = tree
+        self.node_names: Dict[CommonListTree.Node, str] = {}
+        self.stages: List[Stage] = []
+        self.image_args: Dict[str, Any] = {}
+        self.last_stage_per_target: Dict[str, str] = {}
+        # Duplicate stages dropped by `merge_stages`, with the stage that replaced each
+        self.merged: List[Tuple[Stage, str]] = []
+        # Targets whose bare stages `fold_target_stages` dropped
+        self.folded: List[str] = []
+
+
+def _template_fingerprint(module: Module) -> str:
+    return json.dumps(module.template.dict(), sort_keys=True, default=str)
+
+
+_LAYER_INSTRUCTIONS = {"RUN", "COPY", "ADD"}
+
+
+def count_layers(chunk: str) -> int:
+    """Counts the instructions in a rendered chunk that add filesystem layers"""
+    layers = 0
+    continued = False
+    for line in chunk.splitlines():
+        stripped = line.strip()
+        if not continued and stripped and not stripped.startswith("#"):
+            if stripped.split(None, 1)[0].upper() in _LAYER_INSTRUCTIONS:
+                layers += 1
+        continued = stripped.endswith("\\")
+    return layers
+
+
+def merge_stages(plan: StagePlan, nodes: List[CommonListTree.Node], targets: int):
+    """Merges stages that would render identically, wherever they are in the tree
+
+    The prefix tree only shares stages between targets whose module lists start the
+    same way. Two stages render the same chunk when their modules use the same template
+    and variables and their bases are themselves merged (or the template fixes `base`),
+    so each group of such stages is emitted once. Targets whose own stage was merged
+    away get a bare stage on top of the merged one.
+    """
+    group_of: Dict[str, int] = {}
+    groups: Dict[tuple, int] = {}
+    members: List[List[int]] = []
+    for i, stage in enumerate(plan.stages):
+        fixed_base = "base" in stage.module.template.variables
+        key = (
+            _template_fingerprint(stage.module),
+            None if fixed_base else group_of.get(stage.base),
+        )
+        group = groups.setdefault(key, len(groups))
+        if group == len(members):
+            members.append([])
+        members[group].append(i)
+        group_of[stage.name] = group
+
+    group_names = []
+    for group in members:
+        stages = [plan.stages[i] for i in group]
+        target_named = [s.name for s in stages if s.name in plan.last_stage_per_target]
+        if target_named:
+            name = target_named[0]
+        elif len(stages) == 1:
+            name = stages[0].name
+        else:
+            labels = set().union(*(nodes[i].labels for i in group))
+            module = stages[0].module
+            if len(labels) == targets:
+                name = module.name
+            else:
+                name = "-".join([module.name] + sorted(labels))
+        group_names.append(name)
+
+    merged_stages = []
+    plan.last_stage_per_target = {}
+    for i, stage in enumerate(plan.stages):
+        name = group_names[group_of[stage.name]]
+        plan.node_names[nodes[i]] = name
+        for label in nodes[i].labels:
+            plan.last_stage_per_target[label] = name
+        if members[group_of[stage.name]][0] == i:
+            base = stage.base
+            if base is not None:
+                base = group_names[group_of[base]]
+            merged_stages.append(Stage(stage.module, base, name))
+        else:
+            plan.merged.append((stage, name))
+    plan.stages = merged_stages
+
+
+def fold_target_stages(plan: StagePlan):
+    """Drops bare target stages, naming the stage each is built on after its target
+
+    A bare `FROM <stage> AS <target>` adds nothing to the image, but is one more stage
+    to build and cache. Each stage takes the name of at most one target, and stages
+    already named after a target keep their names; other targets ending there keep
+    their bare stages.
+    """
+    targets = set(plan.last_stage_per_target)
+    module_stages = {stage.name for stage in plan.stages if stage.module is not None}
+    renamed: Dict[str, str] = {}
+    for stage in plan.stages:
+        if (
+            stage.module is None
+            and stage.base in module_stages
+            and stage.base not in targets
+            and stage.base not in renamed
+        ):
+            renamed[stage.base] = stage.name
+    if not renamed:
+        return
+
+    plan.stages = [
+        Stage(
+            stage.module,
+            renamed.get(stage.base, stage.base),
+            renamed.get(stage.name, stage.name),
+        )
+        for stage in plan.stages
+        if stage.module is not None or renamed.get(stage.base) != stage.name
+    ]
+    for node, name in plan.node_names.items():
+        plan.node_names[node] = renamed.get(name, name)
+    for target, name in plan.last_stage_per_target.items():
+        plan.last_stage_per_target[target] = renamed.get(name, name)
+    plan.merged = [(stage, renamed.get(name, name)) for stage, name in plan.merged]
+    plan.folded = sorted(renamed.values())
+
+
+def _render_stage(
+    environment: jinja2.Environment,
+    stage: Stage,
+    chunk_cache: Optional["ChunkCache"] = None,
+) -> str:
+    if stage.module is None:
+        return environment.get_template("stage.Dockerfile.jinja2").render(
+            base=stage.base,
+            name=stage.name,
+            labels={},
+            arguments={},
+            env={},
+        )
+    get_chunk = chunk_cache.get_chunk if chunk_cache else Module.get_chunk
+    return get_chunk(stage.module, environment, stage.base, stage.name)
+
+
+def _render_stages(
+    environment: jinja2.Environment,
+    stages: List[Stage],
+    chunk_cache: Optional["ChunkCache"] = None,
+    workers: Optional[int] = None,
+) -> Iterator[str]:
+    """Renders each stage's chunk, in order, rendering modules on up to `workers`
+    processes at once
+
+    Stages are named before anything is rendered, so each chunk depends only on its
+    own module, name, and base, and chunks can be rendered in any order.
+    """
+    jobs = []
+    keys = {}
+    cached = {}
+    if workers is not None and workers > 1:
+        for i, stage in enumerate(stages):
+            if stage.module is None:
+                continue  # Bare target stages are quick to render here
+            if chunk_cache is not None:
+                keys[i] = chunk_cache.key(stage.module, stage.base, stage.name)
+                cached[i] = chunk_cache.get(keys[i])
+                if cached[i] is not None:
+                    continue
+            jobs.append(i)
+    if not jobs:
+        for i, stage in enumerate(stages):
+            yield cached.get(i) or _render_stage(environment, stage, chunk_cache)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_start_render_worker,
+        initargs=(environment.loader, environment.bytecode_cache),
+    ) as executor:
+        rendered = executor.map(
+            _render_in_worker,
+            [_RenderJob.of(stages[i]) for i in jobs],
+            chunksize=max(1, len(jobs) // (workers * 4)),
+        )
+        jobs = set(jobs)
+        for i, stage in enumerate(stages):
+            if i not in jobs:
+                yield cached.get(i) or _render_stage(environment, stage, chunk_cache)
+                continue
+            chunk = next(rendered)
+            if chunk_cache is not None:
+                chunk_cache.put(keys[i], chunk)
+            yield chunk
+
+
+class _RenderJob(NamedTuple):
+    """What a worker process needs to render one stage"""
+
+    module: str
+    template: FilledTemplate
+    base: Optional[str]
+    name: str
+
+    @classmethod
+    def of(cls, stage: Stage) -> "_RenderJob":
+        # Modules aren't sent whole, as they refer to every module they depend on
+        return cls(stage.module.name, stage.module.template, stage.base, stage.name)
+
+
+_worker_environment: Optional[jinja2.Environment] = None
+
+
+def _start_render_worker(
+    loader: jinja2.BaseLoader, bytecode_cache: Optional[jinja2.BytecodeCache]
+):
+    global _worker_environment
+    _worker_environment = jinja2.Environment(
+        loader=loader, bytecode_cache=bytecode_cache, auto_reload=False, cache_size=-1
+    )
+
+
+def _render_in_worker(job: _RenderJob) -> str:
+    module = Module.construct(name=job.module, template=job.template)
+    return module.get_chunk(_worker_environment, job.base, job.name)
+
+
+FINGERPRINT_LABEL = "docker-printer.fingerprint"
+
+
+def stage_fingerprint(
+    chunk: str, parent: Optional[str], image_args: Dict[str, Any]
+) -> str:
+    """Identifies a stage's image by its rendered chunk, the image args it uses, and
+    the fingerprint of the stage it's built on (if any)
+    """
+    encoded = json.dumps([parent, image_args, chunk], sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def _stage_contents(
+    stage: Stage, chunk: str, fingerprints: Dict[str, str]
+) -> Tuple[Optional[str], str]:
+    """The fingerprint of the stage a chunk builds on (if any), and the chunk with its
+    first `FROM` naming that fingerprint or image instead of any stage
+
+    Shared stages are named after the targets using them, so those names can't be
+    part of a fingerprint.
+    """
+    from .dockerfile import from_line
+
+    match = from_line(chunk)
+    if match is None:
+        return None, chunk
+    words = match.group(1).replace("\\\n", " ").split()
+    flags = [word for word in words if word[:2] == "--"]
+    image = next((word for word in words if word[:2] != "--"), "")
+    parent = None
+    if image == stage.base:
+        parent = fingerprints.get(stage.base)
+        image = parent or image
+    line = " ".join(["FROM", *flags, image])
+    return parent, chunk[: match.start()] + line + chunk[match.end() :]
+
+
+def _fingerprint_stages(
+    stages: List[Stage],
+    chunks: Iterable[str],
+    image_args: Dict[str, Any],
+    fingerprints: Dict[str, str],
+    label: bool = False,
+) -> Iterator[str]:
+    # One pass over a chunk finds every image arg it refers to
+    references = None
+    if image_args:
+        names = "|".join(re.escape(name) for name in image_args)
+        references = re.compile(rf"\${{?({names})\b")
+    # Parents always come first, so their fingerprints are known by their children's
+    for stage, chunk in zip(stages, chunks):
+        used = set(references.findall(chunk)) if references is not None else set()
+        if stage.module is not None:
+            used.update(stage.module.image_args)
+        used_args = {name: value for name, value in image_args.items() if name in used}
+        parent, contents = _stage_contents(stage, chunk, fingerprints)
+        fingerprint = stage_fingerprint(contents, parent, used_args)
+        fingerprints[stage.name] = fingerprint
+        if label:
+            chunk = (
+                chunk.rstrip("\n") + f'\nLABEL {FINGERPRINT_LABEL}="{fingerprint}"\n'
+            )
+        yield chunk
+
+
+def _optimize_stages(
+    stages: List[Stage], chunks: Iterable[str], savings: Dict[str, "LayerSavings"]
+) -> Iterator[str]:
+    from .dockerfile import base_image
+    from .layers import StageSettings, optimize_chunk
+
+    # A stage starts from what its parent (always earlier) left set, unless its FROM
+    # names some other image
+    settings: Dict[str, StageSettings] = {}
+    for stage, chunk in zip(stages, chunks):
+        base = stage.base if base_image(chunk) == stage.base else None
+        stage_settings = settings[base].copy() if base in settings else StageSettings()
+        chunk, stage_savings = optimize_chunk(chunk, stage_settings)
+        settings[stage.name] = stage_settings
+        if stage.name in savings:  # Folded target stages already count their FROM
+            stage_savings.instructions += savings[stage.name].instructions
+        stage_savings.base = base
+        savings[stage.name] = stage_savings
+        yield chunk
+
+
+def _iter_dockerfile(
+    environment: jinja2.Environment,
+    image_args: Dict[str, Any],
+    stages: List[Stage],
+    chunk_cache: Optional["ChunkCache"] = None,
+    workers: Optional[int] = None,
+    fingerprints: Optional[Dict[str, str]] = None,
+    label_fingerprints: bool = False,
+    layer_savings: Optional[Dict[str, "LayerSavings"]] = None,
+) -> Iterator[str]:
+    chunks = _render_stages(environment, stages, chunk_cache, workers)
+    if layer_savings is not None:
+        chunks = _optimize_stages(stages, chunks, layer_savings)
+    if fingerprints is not None or label_fingerprints:
+        chunks = _fingerprint_stages(
+            stages,
+            chunks,
+            image_args,
+            {} if fingerprints is None else fingerprints,
+            label_fingerprints,
+        )
+    pieces = environment.get_template("base.Dockerfile.jinja2").generate(
+        image_arguments=image_args, chunks=chunks
+    )
+    return collapse_blank_lines(pieces)
+
+
+def _module_tree(targets: List[Target]) -> CommonListTree:
+    # Targets loaded from a compiled snapshot are already resolved
+    unresolved = [target for target in targets if target._all_modules is None]
+    if unresolved:
+        with profiling.span("resolve_dependencies"):
+            resolve_dependencies(unresolved)
+
+    with profiling.span("merge_tree"):
+        module_tree = CommonListTree()
+        for target in targets:
+            module_tree.merge_list(target.all_modules(), target.name)
+    return module_tree
+
+
 class TargetCollection(BaseModel):
     __root__: Set[Target]
 
@@ -212,30 +770,26 @@ class TargetCollection(BaseModel):
     #     except StopIteration:
     #         raise KeyError(f"Name {item} not found in target collection")
 
-    def render_dockerfile(
-        self, environment: jinja2.Environment, targets: List[str] = ()
-    ):
-        targets = sorted(self.targets, key=lambda t: t.name)
-
-        pre_image_args = dict()
-        for target in targets:
-            for module in target.all_modules():
-                pre_image_args.update(module.image_args)
-
-        module_tree = CommonListTree()
-        for target in targets:
-            module_tree.merge_list(target.all_modules(), target.name)
-
-        print(module_tree.tree())
-        chunks: Dict[Union[CommonListTree.Node, str], str] = {}
-        names = {}
-        image_args = {}
-        last_chunk_per_target = {}
+    def plan_stages(
+        self,
+        targets: List[Target],
+        merge_duplicates: bool = False,
+        fold_targets: bool = False,
+    ) -> "StagePlan":
+        """Arranges the modules of `targets` into a tree of named stages
+
+        This only names stages; nothing is rendered yet. With `merge_duplicates`,
+        identical stages in different branches of the tree are emitted only once, and
+        with `fold_targets`, bare target stages are folded into their parents.
+        """
+        module_tree = _module_tree(targets)
+        plan = StagePlan(module_tree)
+        names = plan.node_names
 
         def visit_node(
             module: Module, node: CommonListTree.Node, parent: CommonListTree.Node
         ):
-            image_args.update(module.image_args)
+            plan.image_args.update(module.image_args)
 
             if len(node.terminal_labels) == 1:  # This is a terminal node for a target
                 cur_name = list(node.terminal_labels)[0]
@@ -245,31 +799,210 @@ class TargetCollection(BaseModel):
                 cur_name = "-".join([module.name] + list(sorted(node.labels)))
 
             for label in node.labels:
-                last_chunk_per_target[label] = cur_name
+                plan.last_stage_per_target[label] = cur_name
 
             names[node] = cur_name
-            prev_name = names.get(parent)
-            chunks[node] = module.get_chunk(environment, prev_name, cur_name)
+            plan.stages.append(Stage(module, names.get(parent), cur_name))
+            nodes.append(node)
+
+        nodes: List[CommonListTree.Node] = []
+        with profiling.span("name_stages"):
+            module_tree.visit(visit_node)
+        if merge_duplicates:
+            with profiling.span("merge_stages"):
+                merge_stages(plan, nodes, len(targets))
+
+        with profiling.span("add_target_stages"):
+            stage_names = set(names.values())
+            for target in targets:
+                if target.name not in stage_names:
+                    plan.stages.append(
+                        Stage(
+                            None, plan.last_stage_per_target[target.name], target.name
+                        )
+                    )
+        if fold_targets:
+            fold_target_stages(plan)
+
+        return plan
+
+    def select(self, names: Optional[Iterable[str]] = None) -> List[Target]:
+        """The targets with the given names, or all targets if `names` is None"""
+        if names is None:
+            return sorted(self.targets, key=lambda t: t.name)
+        by_name = {target.name: target for target in self.targets}
+        names = set(names)
+        unknown = sorted(names - by_name.keys())
+        if unknown:
+            raise ValueError(f"Unknown target(s): {', '.join(unknown)}")
+        return [by_name[name] for name in sorted(names)]
+
+    def subset(self, names: Iterable[str]) -> "TargetCollection":
+        """A collection of only the named targets (which can still extend any target)"""
+        return self.copy(update=dict(__root__=set(self.select(names))))
+
+    def iter_dockerfile(
+        self,
+        environment: jinja2.Environment,
+        targets: Optional[Iterable[str]] = None,
+        chunk_cache: Optional["ChunkCache"] = None,
+        merge_duplicates: bool = False,
+        title: str = "Dockerfile.synth",
+        verbose: bool = True,
+        workers: Optional[int] = None,
+        fingerprints: Optional[Dict[str, str]] = None,
+        label_fingerprints: bool = False,
+        layer_savings: Optional[Dict[str, "LayerSavings"]] = None,
+    ) -> Iterator[str]:
+        """Renders the Dockerfile lazily, one chunk at a time
+
+        Only the stages needed by `targets` (all targets, by default) are included, and
+        only their modules are resolved. Planning happens immediately; chunks are
+        rendered as the result is consumed, on up to `workers` processes. Unless
+        `verbose` is False, the stage tree is printed first.
+
+        Each stage's fingerprint is added to `fingerprints` as it's rendered, by stage
+        name (every target's final stage is named after it), and with
+        `label_fingerprints`, also set as a label on the stage.
+
+        Given `layer_savings`, bare target stages are folded away and each stage's
+        instructions consolidated (see `layers`), recording what that saved by stage.
+        """
+        targets = self.select(targets)
+        plan = self.plan_stages(
+            targets,
+            merge_duplicates=merge_duplicates,
+            fold_targets=layer_savings is not None,
+        )
+        if layer_savings is not None:
+            from .layers import LayerSavings
+
+            for name in plan.folded:
+                layer_savings[name] = LayerSavings(instructions=1)
+        if verbose:
+            self._print_plan(environment, plan, title, chunk_cache, merge_duplicates)
+        return _iter_dockerfile(
+            environment,
+            plan.image_args,
+            plan.stages,
+            chunk_cache,
+            workers,
+            fingerprints,
+            label_fingerprints,
+            layer_savings,
+        )
 
-        module_tree.visit(visit_node)
-        for target in targets:
-            if target.name not in names.values():
-                chunks[target.name] = environment.get_template(
-                    "stage.Dockerfile.jinja2"
-                ).render(
-                    base=last_chunk_per_target[target.name],
-                    name=target.name,
-                    labels={},
-                    arguments={},
-                    env={},
-                )
+    @staticmethod
+    def _print_plan(
+        environment: jinja2.Environment,
+        plan: StagePlan,
+        title: str,
+        chunk_cache: Optional["ChunkCache"] = None,
+        merge_duplicates: bool = False,
+    ):
+        with profiling.span("print_tree"):
+            print(plan.tree.tree(title))
+
+        if merge_duplicates:
+            # Each dropped stage repeated the layers of the stage that replaced it
+            emitted = {stage.name: stage for stage in plan.stages}
+            layers = sum(
+                count_layers(_render_stage(environment, emitted[name], chunk_cache))
+                for _, name in plan.merged
+            )
+            print(
+                f"Merged {len(plan.merged)} duplicate stage(s), "
+                f"saving {layers} layer(s)"
+            )
 
-        dockerfile = environment.get_template("base.Dockerfile.jinja2").render(
-            image_arguments=image_args, chunks=list(chunks.values())
+    def render_dockerfile(
+        self,
+        environment: jinja2.Environment,
+        targets: Optional[Iterable[str]] = None,
+        chunk_cache: Optional["ChunkCache"] = None,
+        merge_duplicates: bool = False,
+        verbose: bool = True,
+        workers: Optional[int] = None,
+    ) -> str:
+        return "".join(
+            self.iter_dockerfile(
+                environment,
+                targets,
+                chunk_cache,
+                merge_duplicates=merge_duplicates,
+                verbose=verbose,
+                workers=workers,
+            )
         )
-        dockerfile = re.sub(r"\n{3,}", r"\n\n", dockerfile)
 
-        return dockerfile
+
+class BuildCache(BaseModel):
+    """Where a build config imports and exports its build cache, one entry per target
+
+    Exactly one of `registry` (an image ref) or `local` (a directory) is set. Either
+    may use `${TARGET}`, so each target gets its own cache.
+    """
+
+    registry: Optional[str]
+    local: Optional[str]
+    mode: str = "max"
+
+    @validator("local", always=True)
+    def exactly_one_backend(cls, v, values):
+        if (v is None) == (values.get("registry") is None):
+            raise ValueError("Set exactly one of 'registry' or 'local'")
+        return v
+
+    def location(self, target: str) -> str:
+        return (self.registry or self.local).replace("${TARGET}", target)
+
+    def cache_from(self, target: str) -> str:
+        if self.registry:
+            return f"type=registry,ref={self.location(target)}"
+        return f"type=local,src={self.location(target)}"
+
+    def cache_to(self, target: str) -> str:
+        if self.registry:
+            return f"type=registry,ref={self.location(target)},mode={self.mode}"
+        return f"type=local,dest={self.location(target)},mode={self.mode}"
+
+
+def _cache_sources(
+    tree: CommonListTree, target: Target, selected: AbstractSet[str]
+) -> List[str]:
+    """The target itself, then a target sharing each of its stages, nearest first"""
+    path = []
+    node = tree.root
+    for module in target.all_modules():
+        node = node.children[module]
+        path.append(node)
+
+    sources = [target.name]
+    for node in reversed(path):
+        candidates = (node.labels & selected).difference(sources)
+        if candidates:
+            sources.append(min(candidates))
+    return sources
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+# Holds the bake arguments shared by every target in a bake file
+BAKE_COMMON_TARGET = "_common"
+
+
+def _uses_target_name(args) -> bool:
+    if isinstance(args, list):
+        return any(_uses_target_name(a) for a in args)
+    elif isinstance(args, dict):
+        return any(_uses_target_name(a) for a in args.values())
+    elif isinstance(args, str):
+        return "${TARGET}" in args
+    return False
 
 
 class BuildConfig(BaseModel):
@@ -279,6 +1012,9 @@ class BuildConfig(BaseModel):
     tag_postfix: Optional[str]
     build_args: Dict[str, Any] = {"load": True}
     limit_tags: List[str] = []
+    prune: bool = False
+    cache: Optional[BuildCache]
+    dockerignore: bool = False
 
     @validator("image", pre=True)
     def ensure_image_is_list(cls, v):
@@ -300,35 +1036,102 @@ class BuildConfig(BaseModel):
         else:
             return args
 
-    def generate_bakefile(self, target_collection: TargetCollection):
+    def matches(self, target: Target) -> bool:
+        return all(tag in target.tags for tag in self.limit_tags)
+
+    def select_targets(self, target_collection: TargetCollection) -> List[Target]:
+        return [t for t in target_collection.select() if self.matches(t)]
+
+    def generate_bakefile(
+        self,
+        target_collection: TargetCollection,
+        targets: Optional[List[Target]] = None,
+        module_tree: Optional[CommonListTree] = None,
+    ):
+        """Renders the bake file for this config's targets (selected from the collection
+        unless already given)
+
+        Arguments that are the same for every target are set once, on a `_common`
+        target that the others inherit from. Only arguments that use `${TARGET}` are
+        repeated per target. With a `cache`, each target imports its own cache and
+        those of the targets it shares stages with (from `module_tree`, which is built
+        if not given), and exports its own.
+        """
+
         def tag_maker(name):
             return "-".join(v for v in [self.tag_prefix, name, self.tag_postfix] if v)
 
-        targets = [
-            t
-            for t in sorted(target_collection.targets, key=lambda t: t.name)
-            if all(tag in t.tags for tag in self.limit_tags)
-        ]
+        if targets is None:
+            targets = self.select_targets(target_collection)
+
+        common = dict(dockerfile=self.dockerfile_name)
+        per_target = {}
+        for key, value in self.build_args.items():
+            if _uses_target_name(value) or (
+                self.cache and key in ("cache-from", "cache-to")
+            ):
+                per_target[key] = value
+            else:
+                common[key] = value
+
+        cache_args = {}
+        if self.cache:
+            if module_tree is None:
+                module_tree = _module_tree(targets)
+            selected = {target.name for target in targets}
+            for target in targets:
+                sources = _cache_sources(module_tree, target, selected)
+                cache_args[target.name] = {
+                    # Targets share one entry if the location doesn't use ${TARGET}
+                    "cache-from": list(
+                        dict.fromkeys(self.cache.cache_from(name) for name in sources)
+                    ),
+                    "cache-to": [self.cache.cache_to(target.name)],
+                }
+
+        def target_args(target: Target):
+            args = self._render_build_args(target, per_target)
+            for key, values in cache_args.get(target.name, {}).items():
+                args[key] = _as_list(args.get(key)) + values
+            return args
 
         return json.dumps(
             dict(
                 group=dict(default=dict(targets=[target.name for target in targets])),
                 target={
-                    target.name: dict(
-                        dockerfile="Dockerfile.synth",
-                        tags=[f"{img}:{tag_maker(target.name)}" for img in self.image],
-                        target=target.name,
-                        **self._render_build_args(target, self.build_args),
-                    )
-                    for target in targets
+                    BAKE_COMMON_TARGET: common,
+                    **{
+                        target.name: dict(
+                            inherits=[BAKE_COMMON_TARGET],
+                            tags=[
+                                f"{img}:{tag_maker(target.name)}" for img in self.image
+                            ],
+                            target=target.name,
+                            **target_args(target),
+                        )
+                        for target in targets
+                    },
                 },
             ),
             indent=2,
         )
 
+    @property
+    def dockerfile_name(self):
+        """A Dockerfile of only this config's targets if `prune` is set, else the full one"""
+        return f"Dockerfile.{self.name}.synth" if self.prune else "Dockerfile.synth"
+
+    @property
+    def context_dir(self) -> str:
+        return self.build_args.get("context", ".")
+
+    @property
+    def bakefile_name(self):
+        return f"docker-bake.{self.name}.json"
+
     @property
     def build_command(self):
-        return f"docker buildx bake -f docker-bake.{self.name}.json"
+        return f"docker buildx bake -f {self.bakefile_name}"
 
 
 class BuildConfigCollection(BaseModel):
@@ -337,3 +1140,18 @@ class BuildConfigCollection(BaseModel):
     @property
     def configs(self):
         return [t for t in self.__root__]
+
+    def generate_bakefiles(self, target_collection: TargetCollection) -> Dict[str, str]:
+        """Renders the bake file of every config, sorting the targets only once"""
+        targets = target_collection.select()
+        module_tree = None
+        if any(config.cache for config in self.configs):
+            module_tree = _module_tree(targets)
+        return {
+            config.name: config.generate_bakefile(
+                target_collection,
+                [t for t in targets if config.matches(t)],
+                module_tree,
+            )
+            for config in self.configs
+        }
@@ -0,0 +1,151 @@
+"""Suggesting module priorities that put often-changed modules late in each target's
+chain of stages, from how often git history shows them changing."""
+
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from .affected import TemplateGraph, changed_modules, git
+from .models import Module, Target
+
+# A commit that changes every stage, whatever the order
+EVERYTHING = frozenset(["*"])
+
+
+def git_history(
+    path: Path, cwd: Path, max_count: int = 1000, since: Optional[str] = None
+) -> List[Set[Path]]:
+    """The files below `path` changed by each of the last `max_count` commits (and
+    only those `since` a date, if given), newest first
+    """
+    args = ["-c", "core.quotePath=false", "log", f"--max-count={max_count}"]
+    if since:
+        args.append(f"--since={since}")
+    output = git(
+        *args, "--format=%x00", "--name-only", "--relative", "--", str(path), cwd=cwd
+    )
+    commits: List[Set[Path]] = []
+    for line in output.splitlines():
+        if line == "\0":
+            commits.append(set())
+        elif line and commits:
+            commits[-1].add((cwd / line).resolve())
+    return commits
+
+
+def module_history(
+    commits: Iterable[Set[Path]],
+    modules: Iterable[Module],
+    module_files: Dict[Path, str],
+    templates: TemplateGraph,
+) -> List[frozenset]:
+    """The names of the modules each commit changed, directly or through a template
+    they use, or `EVERYTHING` for commits that change every stage
+    """
+    modules = list(modules)
+    history = []
+    for changed in commits:
+        names = changed_modules(changed, modules, module_files, templates)
+        if names is None:
+            history.append(EVERYTHING)
+        elif names:
+            history.append(frozenset(names))
+    return history
+
+
+def hit_rate(chains: Iterable[List[str]], history: List[frozenset]) -> float:
+    """The share of stages whose cache survives each commit in `history`
+
+    Targets whose chains start the same way share those stages, so each distinct
+    prefix of a chain is counted once. A stage is rebuilt when a commit changes any
+    module in it or before it.
+    """
+    prefixes = {tuple(chain[: i + 1]) for chain in chains for i in range(len(chain))}
+    if not prefixes or not history:
+        return 1.0
+    sets = [frozenset(prefix) for prefix in prefixes]
+    rebuilt = 0
+    for changed in history:
+        if changed is EVERYTHING:
+            rebuilt += len(sets)
+        else:
+            rebuilt += sum(1 for modules in sets if not modules.isdisjoint(changed))
+    return 1 - rebuilt / (len(sets) * len(history))
+
+
+def suggest_order(modules: List[Module], volatility: Dict[str, int]) -> List[Module]:
+    """`modules` in a build order that `depends_on` allows, putting the least often
+    changed ones first wherever there's a choice
+
+    Modules whose templates set their own `base` start from an image rather than the
+    stage before them, so they always come first. Ties keep the current order.
+    """
+    current = {
+        module.name: i
+        for i, module in enumerate(sorted(modules, key=lambda m: (-m.priority, m.name)))
+    }
+    by_name = {module.name: module for module in modules}
+    waiting = {
+        name: {dep for dep in module.depends_on if dep in by_name}
+        for name, module in by_name.items()
+    }
+
+    def key(name: str):
+        fixed_base = "base" in by_name[name].template.variables
+        return (not fixed_base, volatility.get(name, 0), current[name])
+
+    order = []
+    while waiting:
+        ready = [name for name, deps in waiting.items() if not deps]
+        if not ready:  # A cycle, which loading the config already rejects
+            ready = list(waiting)
+        name = min(ready, key=key)
+        order.append(by_name[name])
+        del waiting[name]
+        for deps in waiting.values():
+            deps.discard(name)
+    return order
+
+
+def suggest_priorities(order: List[Module]) -> Dict[str, int]:
+    """Priorities that sort modules into `order`, keeping each current priority that
+    already does
+    """
+    priorities = {}
+    previous: Optional[Module] = None
+    for module in order:
+        priority = module.priority
+        if previous is not None:
+            above = priorities[previous.name]
+            if priority > above or (priority == above and module.name < previous.name):
+                priority = above - 1
+        priorities[module.name] = priority
+        previous = module
+    return priorities
+
+
+def target_chains(targets: Iterable[Target], order: List[Module]) -> List[List[str]]:
+    """Each target's modules, in `order`"""
+    index = {module.name: i for i, module in enumerate(order)}
+    return [
+        sorted((module.name for module in target.all_modules()), key=index.__getitem__)
+        for target in targets
+    ]
+
+
+_priority_line = re.compile(r"^priority:[^\n]*$", re.MULTILINE)
+_name_line = re.compile(r"^name:[^\n]*$", re.MULTILINE)
+
+
+def write_priority(path: Path, priority: int):
+    """Sets the top-level `priority` in a module file, keeping its other lines as is"""
+    text = path.read_text()
+    line = f"priority: {priority}"
+    if _priority_line.search(text):
+        text = _priority_line.sub(line, text, count=1)
+    elif _name_line.search(text):
+        match = _name_line.search(text)
+        text = f"{text[: match.end()]}\n{line}{text[match.end() :]}"
+    else:
+        text = f"{line}\n{text}"
+    path.write_text(text)
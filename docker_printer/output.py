@@ -0,0 +1,72 @@
+"""Streaming, atomic writes for synthesized files."""
+
+import hashlib
+import os
+import re
+import secrets
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+
+_newlines = re.compile(r"(\n+)")
+
+
+def collapse_blank_lines(pieces: Iterable[str]) -> Iterator[str]:
+    """Streaming equivalent of `re.sub(r"\\n{3,}", "\\n\\n", "".join(pieces))`"""
+    run = 0  # Newlines already emitted at the end of the output so far
+    for piece in pieces:
+        out = []
+        for part in _newlines.split(piece):
+            if not part:
+                continue
+            if part[0] == "\n":
+                # A run may continue from the previous piece; emit at most two in total
+                total = run + len(part)
+                if total <= 2:
+                    out.append(part)
+                elif run < 2:
+                    out.append("\n" * (2 - run))
+                run = min(total, 2)
+            else:
+                out.append(part)
+                run = 0
+        if out:
+            yield "".join(out)
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class WriteResult(NamedTuple):
+    changed: bool
+    digest: str
+
+
+def write_if_changed(path: Path, pieces: Iterable[str]) -> WriteResult:
+    """Streams `pieces` to a temporary file, then moves it over `path` only if different
+
+    An unchanged file is left untouched, so its mtime doesn't trigger file watchers or
+    build context checks. Readers never see a partially written file.
+    """
+    digest = hashlib.sha256()
+    tmp_path = path.with_name(f".{path.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        with open(tmp_path, "x", encoding="utf-8", newline="\n") as f:
+            for piece in pieces:
+                f.write(piece)
+                digest.update(piece.encode("utf-8"))
+        new_digest = digest.hexdigest()
+
+        if path.exists() and path.stat().st_size == tmp_path.stat().st_size:
+            if file_digest(path) == new_digest:
+                return WriteResult(False, new_digest)
+
+        os.replace(tmp_path, path)
+        return WriteResult(True, new_digest)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
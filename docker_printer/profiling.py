@@ -0,0 +1,98 @@
+"""Opt-in timing spans for `synth` and `build`, exported as Chrome trace events."""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+_profiler: Optional["Profiler"] = None
+_disabled = contextlib.nullcontext()
+
+
+class Profiler:
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, args: Dict[str, Any]):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            event = dict(
+                name=name,
+                cat=category,
+                ph="X",
+                ts=(start - self._origin) / 1000,
+                dur=(end - start) / 1000,
+                pid=os.getpid(),
+                tid=threading.get_ident(),
+                args=args,
+            )
+            with self._lock:
+                self.events.append(event)
+
+    def write_trace(self, path: Path):
+        """Saves all spans in the Chrome trace-event format (chrome://tracing, Perfetto)"""
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit="ms"), f)
+
+    def totals(self, category: str, key: str) -> List[Tuple[str, float, int]]:
+        """Total milliseconds and count of spans in `category`, grouped by `args[key]`"""
+        durations: Dict[str, float] = defaultdict(float)
+        counts: Dict[str, int] = defaultdict(int)
+        for event in self.events:
+            if event["cat"] == category:
+                group = str(event["args"].get(key, event["name"]))
+                durations[group] += event["dur"] / 1000
+                counts[group] += 1
+        return sorted(
+            ((group, durations[group], counts[group]) for group in durations),
+            key=lambda row: -row[1],
+        )
+
+    def summary(self, limit: int = 10) -> str:
+        lines = []
+        for title, category, key in [
+            ("Phases", "phase", "name"),
+            ("Slowest modules", "chunk", "module"),
+            ("Slowest templates", "chunk", "template"),
+        ]:
+            rows = self.totals(category, key)
+            if not rows:
+                continue
+            lines.append(title)
+            if category != "phase":
+                rows = rows[:limit]
+            for group, total, count in rows:
+                lines.append(f"  {total:10.2f} ms  {count:6d}x  {group}")
+        return "\n".join(lines)
+
+
+def enable() -> Profiler:
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def is_enabled() -> bool:
+    return _profiler is not None
+
+
+def span(name: str, category: str = "phase", **args):
+    """Times the enclosed block when profiling is enabled, and does nothing otherwise"""
+    if _profiler is None:
+        return _disabled
+    return _profiler.span(name, category, args)
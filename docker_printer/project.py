@@ -0,0 +1,187 @@
+"""Loading and synthesizing projects in-process, without the CLI's global state."""
+
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, Optional, Tuple
+
+import jinja2
+
+from .cache import ModuleParseCache
+from .models import (
+    BuildConfigCollection,
+    Module,
+    Registry,
+    TargetCollection,
+)
+from .output import write_if_changed
+from .utils import (
+    _parse_module,
+    base_resources_dir,
+    builds_file,
+    cache_dir,
+    create_jinja_env,
+    jinja_env,
+    preload_modules,
+    targets_file,
+    yml_load,
+)
+
+if TYPE_CHECKING:
+    from .cache import ChunkCache
+
+
+class Project:
+    """A docker-printer project that can be synthesized any number of times in one process
+
+    Each project keeps its own modules, targets, build configs, and Jinja environment,
+    so any number of projects can be loaded side by side. A project isn't meant to be
+    used from several threads at once; load one per thread instead.
+
+    Load one from disk with `Project.load(path)`, or build one from parsed config with
+    `Project.from_dicts(...)`.
+    """
+
+    def __init__(
+        self,
+        registry: Registry,
+        targets: TargetCollection,
+        builds: BuildConfigCollection,
+    ):
+        self.registry = registry
+        self.targets = targets
+        self.builds = builds
+
+    @classmethod
+    def load(cls, path: Path, parse_cache: bool = True) -> "Project":
+        """Loads the project in `path`, the folder that contains `docker-printer/`
+
+        With `parse_cache`, parsed modules are cached in the project's cache folder,
+        like they are by the CLI.
+        """
+        path = Path(path).resolve()
+        if not (path / "docker-printer").is_dir():
+            raise RuntimeError(f"No docker-printer folder found in {path}")
+
+        registry = Registry(base_dir=path)
+        with registry.activate():
+            cache = None
+            if parse_cache:
+                cache = ModuleParseCache.load(cache_dir() / "modules.pickle")
+            preload_modules(cache)
+            if cache is not None:
+                cache.save()
+            targets = TargetCollection.parse_obj(yml_load(targets_file()))
+            builds = BuildConfigCollection.parse_obj(yml_load(builds_file()))
+        return cls(registry, targets, builds)
+
+    @classmethod
+    def from_dicts(
+        cls,
+        modules: Iterable[dict],
+        targets: Iterable[dict],
+        builds: Iterable[dict] = (),
+        templates: Optional[Dict[str, str]] = None,
+    ) -> "Project":
+        """Creates a project from the contents of its config files, without touching disk
+
+        `modules`, `targets`, and `builds` hold what module files, `targets.yml`, and
+        `builds.yml` would, and `templates` maps template names to their source.
+        Built-in modules and templates are available as usual.
+        """
+        registry = Registry()
+        resources = base_resources_dir()
+        registry.environment = create_jinja_env(
+            jinja2.ChoiceLoader(
+                [
+                    jinja2.DictLoader(templates or {}),
+                    jinja2.FileSystemLoader(str(resources / "templates")),
+                ]
+            )
+        )
+        with registry.activate():
+            for path in sorted((resources / "modules").rglob("*.yml")):
+                _parse_module(path).register()
+            for data in modules:
+                Module(**data)
+            target_collection = TargetCollection.parse_obj(list(targets))
+            build_configs = BuildConfigCollection.parse_obj(list(builds))
+        return cls(registry, target_collection, build_configs)
+
+    @property
+    def base_dir(self) -> Optional[Path]:
+        return self.registry.base_dir
+
+    @property
+    def environment(self) -> jinja2.Environment:
+        with self.activate():
+            return jinja_env()
+
+    @property
+    def modules(self) -> Dict[str, Module]:
+        return self.registry.modules
+
+    def activate(self):
+        """Makes this project's modules and targets the ones model lookups see"""
+        return self.registry.activate()
+
+    def render_dockerfile(
+        self,
+        targets: Optional[Iterable[str]] = None,
+        merge_duplicates: bool = False,
+        chunk_cache: Optional["ChunkCache"] = None,
+        workers: Optional[int] = None,
+    ) -> str:
+        """The Dockerfile for `targets` (all targets, by default), rendering stages on
+        up to `workers` processes
+        """
+        with self.activate():
+            return self.targets.render_dockerfile(
+                self.environment,
+                targets,
+                chunk_cache,
+                merge_duplicates=merge_duplicates,
+                verbose=False,
+                workers=workers,
+            )
+
+    def render_bakefiles(self) -> Dict[str, str]:
+        """Each build config's bake file, by config name"""
+        with self.activate():
+            return self.builds.generate_bakefiles(self.targets)
+
+    def iter_outputs(
+        self,
+        merge_duplicates: bool = False,
+        chunk_cache: Optional["ChunkCache"] = None,
+    ) -> Iterator[Tuple[str, str]]:
+        """Every Dockerfile and bake file `synth` writes, as (file name, content) pairs
+
+        Ignore files for build configs with `dockerignore` aren't included, as they
+        depend on the files in the build context.
+        """
+        yield "Dockerfile.synth", self.render_dockerfile(
+            merge_duplicates=merge_duplicates, chunk_cache=chunk_cache
+        )
+        for config in self.builds.configs:
+            if config.prune:
+                target_names = [t.name for t in config.select_targets(self.targets)]
+                yield config.dockerfile_name, self.render_dockerfile(
+                    target_names,
+                    merge_duplicates=merge_duplicates,
+                    chunk_cache=chunk_cache,
+                )
+
+        bakefiles = self.render_bakefiles()
+        for config in self.builds.configs:
+            yield config.bakefile_name, bakefiles[config.name] + "\n"
+
+    def synth(self, merge_duplicates: bool = False) -> Dict[Path, bool]:
+        """Writes every output of `iter_outputs` next to the `docker-printer` folder,
+        returning whether each file changed
+        """
+        if self.base_dir is None:
+            raise RuntimeError("Only projects loaded from a folder can be written out")
+        changed = {}
+        for name, content in self.iter_outputs(merge_duplicates=merge_duplicates):
+            path = self.base_dir / name
+            changed[path] = write_if_changed(path, [content]).changed
+        return changed
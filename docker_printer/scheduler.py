@@ -0,0 +1,241 @@
+"""Concurrent, dependency-aware builds of the stages in a synthesized Dockerfile."""
+
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .models import CommonListTree, StagePlan
+
+
+class BuildJob:
+    """A target to build, or a shared stage to build once before its dependents"""
+
+    def __init__(self, name: str, target: Optional[str], depends_on: List["BuildJob"]):
+        self.name = name
+        # The bake target to build, or None for a shared stage that isn't a target
+        self.target = target
+        # A target built on this job, whose bake settings are used to build a stage
+        self.representative = target
+        self.depends_on = depends_on
+        self.status = "pending"
+        self.seconds: Optional[float] = None
+
+    @property
+    def is_stage(self):
+        return self.target is None
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+
+def plan_jobs(plan: StagePlan, targets: Iterable[str]) -> List[BuildJob]:
+    """Derives build jobs from the stage tree, ordered so dependencies come first
+
+    Each selected target depends on the nearest selected target or shared stage above
+    it in the tree. A stage gets its own job when two or more selected targets fan out
+    from it, so its layers are built once and every dependent reuses them from cache.
+    """
+    selected = set(targets)
+    jobs: List[BuildJob] = []
+    job_for_node: Dict[CommonListTree.Node, Optional[BuildJob]] = {plan.tree.root: None}
+    job_for_name: Dict[str, BuildJob] = {}
+
+    def visit_node(value, node: CommonListTree.Node, parent: CommonListTree.Node):
+        parent_job = job_for_node[parent]
+        job = parent_job
+        name = plan.node_names[node]
+        ending = sorted(selected & node.terminal_labels)
+        continuing = sum(
+            1 for child in node.children.values() if selected & child.labels
+        )
+
+        if name in job_for_name:  # A stage merged with one that already has a job
+            job = job_for_name[name]
+        elif name in selected or len(ending) + continuing >= 2:
+            target = name if name in selected else None
+            job = BuildJob(name, target, [parent_job] if parent_job else [])
+            jobs.append(job)
+            job_for_name[name] = job
+
+        # Targets that end here without a stage of their own get bare `FROM` stages
+        for label in ending:
+            if label != name:
+                jobs.append(BuildJob(label, label, [job] if job else []))
+        job_for_node[node] = job
+
+    plan.tree.visit(visit_node)
+    return jobs
+
+
+class Executor:
+    """Runs a single build job; subclasses decide how"""
+
+    def run(self, job: BuildJob, log: Callable[[str], None]) -> int:
+        raise NotImplementedError
+
+    def cancel(self):
+        """Stops any jobs that are still running"""
+
+
+class BakeExecutor(Executor):
+    """Builds jobs with `docker buildx bake` against a synthesized bakefile"""
+
+    def __init__(self, bakefile: str, docker: str = "docker"):
+        self.bakefile = bakefile
+        self.docker = docker
+        self._processes: List[subprocess.Popen] = []
+        self._lock = threading.Lock()
+
+    def command(self, job: BuildJob, representative: str) -> List[str]:
+        command = [self.docker, "buildx", "bake", "-f", self.bakefile]
+        if job.is_stage:
+            # Build the shared stage into the build cache only, borrowing the settings
+            # of a target that uses it
+            command += [
+                "--set",
+                f"{representative}.target={job.name}",
+                "--set",
+                f"{representative}.output=type=cacheonly",
+            ]
+        return command + [representative]
+
+    def run(self, job: BuildJob, log: Callable[[str], None]) -> int:
+        command = self.command(job, job.representative)
+        log(" ".join(command))
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        with self._lock:
+            self._processes.append(process)
+        for line in process.stdout:
+            log(line.rstrip("\n"))
+        return process.wait()
+
+    def cancel(self):
+        with self._lock:
+            for process in self._processes:
+                if process.poll() is None:
+                    process.terminate()
+
+
+# Statuses of jobs that dependent jobs can build on
+_DONE = {"succeeded", "up to date"}
+
+
+def mark_up_to_date(jobs: List[BuildJob], is_built: Callable[[BuildJob], bool]):
+    """Marks target jobs whose images are already built as up to date, along with
+    shared stages that only up-to-date targets build on
+    """
+    dependents: Dict[BuildJob, List[BuildJob]] = {job: [] for job in jobs}
+    for job in jobs:
+        for dep in job.depends_on:
+            dependents[dep].append(job)
+    for job in reversed(jobs):  # Dependents first
+        if job.is_stage:
+            up_to_date = all(dep.status == "up to date" for dep in dependents[job])
+        else:
+            up_to_date = is_built(job)
+        if up_to_date:
+            job.status = "up to date"
+
+
+class BuildScheduler:
+    """Runs jobs concurrently, each as soon as everything it depends on has finished
+
+    Stops scheduling new jobs, and cancels running ones, as soon as any job fails.
+    """
+
+    def __init__(
+        self,
+        jobs: List[BuildJob],
+        executor: Executor,
+        max_workers: int = 1,
+        echo: Callable[[str], None] = print,
+    ):
+        self.jobs = jobs
+        self.executor = executor
+        self.max_workers = max_workers
+        self.echo = echo
+        self._echo_lock = threading.Lock()
+        _assign_representatives(jobs)
+
+    def _logger(self, job: BuildJob) -> Callable[[str], None]:
+        width = max(len(j.name) for j in self.jobs)
+
+        def log(line: str):
+            with self._echo_lock:
+                self.echo(f"[{job.name:<{width}}] {line}")
+
+        return log
+
+    def _run(self, job: BuildJob) -> int:
+        start = time.perf_counter()
+        try:
+            return self.executor.run(job, self._logger(job))
+        finally:
+            job.seconds = time.perf_counter() - start
+
+    def run(self) -> bool:
+        """Runs every job, returning whether they all succeeded"""
+        pending = [job for job in self.jobs if job.status == "pending"]
+        running: Dict[Future, BuildJob] = {}
+        failed = False
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if not failed:
+                    ready = [
+                        job
+                        for job in pending
+                        if all(dep.status in _DONE for dep in job.depends_on)
+                    ]
+                    for job in ready[: self.max_workers - len(running)]:
+                        pending.remove(job)
+                        job.status = "running"
+                        running[pool.submit(self._run, job)] = job
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        succeeded = future.result() == 0
+                    except Exception as e:
+                        self._logger(job)(f"Error: {e}")
+                        succeeded = False
+                    if succeeded:
+                        job.status = "succeeded"
+                    else:
+                        job.status = "cancelled" if failed else "failed"
+                    if not succeeded and not failed:
+                        failed = True
+                        self.executor.cancel()
+
+        for job in pending:
+            job.status = "skipped"
+        return not failed
+
+    def summary(self) -> str:
+        lines = []
+        for job in self.jobs:
+            seconds = f"{job.seconds:8.1f}s" if job.seconds is not None else " " * 9
+            kind = "stage " if job.is_stage else "target"
+            lines.append(f"{seconds}  {job.status:<10}  {kind}  {job.name}")
+        return "\n".join(lines)
+
+
+def _assign_representatives(jobs: List[BuildJob]):
+    # Walk dependents-first, so each stage job borrows the first target built on it
+    dependents: Dict[BuildJob, List[BuildJob]] = {job: [] for job in jobs}
+    for job in jobs:
+        for dep in job.depends_on:
+            dependents[dep].append(job)
+    for job in reversed(jobs):
+        if job.representative is None:
+            job.representative = dependents[job][0].representative
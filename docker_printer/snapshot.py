@@ -0,0 +1,159 @@
+"""Compiled snapshots of a project's config, which load without parsing or validation."""
+
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pydantic
+
+from . import __version__
+from .cache import UNPICKLING_ERRORS, _is_settled, data_digest
+from .models import (
+    BuildConfigCollection,
+    Module,
+    TargetCollection,
+    active_registry,
+    resolve_dependencies,
+)
+from .output import file_digest
+from .utils import (
+    builds_source,
+    builds_template_context,
+    cache_dir,
+    module_files,
+    targets_source,
+)
+
+SNAPSHOT_FORMAT = 2
+
+
+def snapshot_path() -> Path:
+    return cache_dir() / "config.snapshot"
+
+
+def _sources() -> List[Path]:
+    return [*module_files(), targets_source(), builds_source()]
+
+
+def _context_digest() -> Optional[str]:
+    if builds_source().suffix != ".jinja2":
+        return None
+    return data_digest(builds_template_context())
+
+
+class ConfigSnapshot:
+    """Every module, target, and build config of a project, with dependencies resolved
+
+    Snapshots are pickled, so loading one skips YAML parsing and pydantic validation.
+    A snapshot is only used while the hashes of its source files, the docker-printer
+    and pydantic versions, and the context of a templated `builds.yml` all match.
+    """
+
+    def __init__(
+        self,
+        modules: List[Module],
+        targets: TargetCollection,
+        builds: BuildConfigCollection,
+        sources: Dict[str, list] = None,
+        context: Optional[str] = None,
+    ):
+        self.modules = modules
+        self.targets = targets
+        self.builds = builds
+        # Path -> [mtime, size, digest], with no mtime if it changed as it was hashed
+        self.sources = sources or {}
+        self.context = context
+
+    @classmethod
+    def compile(
+        cls, targets: TargetCollection, builds: BuildConfigCollection
+    ) -> "ConfigSnapshot":
+        """Snapshots the loaded project, resolving the closures of every target"""
+        resolve_dependencies(targets.targets)
+        sources = {}
+        for path in _sources():
+            stat = path.stat()
+            mtime = stat.st_mtime_ns if _is_settled(stat) else None
+            sources[str(path)] = [mtime, stat.st_size, file_digest(path)]
+        return cls(
+            list(active_registry().modules.values()),
+            targets,
+            builds,
+            sources,
+            _context_digest(),
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["ConfigSnapshot"]:
+        """The snapshot in `path`, or None if it's missing or out of date"""
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except (OSError, *UNPICKLING_ERRORS):
+            return None
+        if (
+            not isinstance(data, dict)
+            or data.get("format") != SNAPSHOT_FORMAT
+            or data.get("versions")
+            != [
+                __version__,
+                pydantic.VERSION,
+            ]
+        ):
+            return None
+        # Only unpickled once the versions match, as models may not load otherwise
+        try:
+            config = pickle.loads(data["config"])
+        except UNPICKLING_ERRORS:
+            return None
+        snapshot = cls(*config, sources=data["sources"], context=data["context"])
+        if not snapshot.is_current():
+            return None
+        return snapshot
+
+    def is_current(self) -> bool:
+        paths = _sources()
+        if {str(path) for path in paths} != self.sources.keys():
+            return False
+        for path in paths:
+            mtime, size, digest = self.sources[str(path)]
+            stat = path.stat()
+            if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+                if stat.st_size != size or file_digest(path) != digest:
+                    return False
+        return self.context == _context_digest()
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        # Modules, targets, and configs are pickled together, so that closures keep
+        # referring to the same objects once loaded
+        config = pickle.dumps(
+            (self.modules, self.targets, self.builds), protocol=pickle.HIGHEST_PROTOCOL
+        )
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                dict(
+                    format=SNAPSHOT_FORMAT,
+                    versions=[__version__, pydantic.VERSION],
+                    sources=self.sources,
+                    context=self.context,
+                    config=config,
+                ),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(tmp_path, path)
+
+    def register(self):
+        """Adds the snapshot's modules and targets to the active registry"""
+        registry = active_registry()
+        for module in self.modules:
+            module.register()
+        for target in self.targets.__root__:
+            if target.name in registry.targets:
+                raise RuntimeError(
+                    f"Multiple targets defined with the same name: '{target.name}'"
+                )
+            registry.targets[target.name] = target
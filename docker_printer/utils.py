@@ -1,18 +1,39 @@
 import getpass
+import hashlib
+import os
 import platform
 from functools import lru_cache
 from importlib import resources
 from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 import jinja2
 import yaml
-from yaml.scanner import ScannerError
+from pydantic import ValidationError
 
-from .models import Module
+from .models import Module, active_registry
+from .output import write_if_changed
+
+if TYPE_CHECKING:
+    from .cache import ModuleParseCache
+
+# Prefer the libyaml-backed loader, which is several times faster, when it's available
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
-@lru_cache(maxsize=None)
 def base_dir(default_to_local=False) -> Path:
+    """The project's top-level directory: the active `Project`'s, if there is one, and
+    otherwise the nearest directory above the working directory with a `docker-printer`
+    folder in it
+    """
+    root_dir = active_registry().base_dir
+    if root_dir is not None:
+        return root_dir
+    return _find_base_dir(default_to_local)
+
+
+@lru_cache(maxsize=None)
+def _find_base_dir(default_to_local=False) -> Path:
     root_dir = Path().resolve()
     while not (root_dir / "docker-printer").exists():
         if root_dir == root_dir.parent:
@@ -26,61 +47,182 @@ def base_dir(default_to_local=False) -> Path:
     return root_dir
 
 
-@lru_cache(maxsize=None)
 def config_dir(default_to_local=False) -> Path:
     return base_dir(default_to_local=default_to_local) / "docker-printer"
 
 
+def user_cache_dir() -> Path:
+    """Where docker-printer keeps caches for the current user"""
+    if os.environ.get("XDG_CACHE_HOME"):
+        root = Path(os.environ["XDG_CACHE_HOME"])
+    elif platform.system() == "Windows" and os.environ.get("LOCALAPPDATA"):
+        root = Path(os.environ["LOCALAPPDATA"])
+    elif platform.system() == "Darwin":
+        root = Path.home() / "Library" / "Caches"
+    else:
+        root = Path.home() / ".cache"
+    return root / "docker-printer"
+
+
+def project_cache_dir(path: Path) -> Path:
+    """The cache folder for the project in `path`
+
+    Caches are loaded without checking where they came from (some are pickled), so
+    they're kept outside the project, where a commit can't plant one.
+    """
+    path = Path(path).resolve()
+    digest = hashlib.sha256(str(path).encode()).hexdigest()[:16]
+    return user_cache_dir() / f"{path.name}-{digest}"
+
+
+def cache_dir() -> Path:
+    return project_cache_dir(base_dir())
+
+
 def base_resources_dir() -> Path:
     with resources.path("docker_printer", "resources") as resources_dir:
         return resources_dir
 
 
-def jinja_env():
+def template_dirs() -> List[Path]:
+    return [
+        config_dir() / "templates",
+        base_resources_dir() / "templates",
+    ]
+
+
+def bytecode_cache() -> jinja2.BytecodeCache:
+    directory = cache_dir() / "jinja"
+    directory.mkdir(parents=True, exist_ok=True)
+    return jinja2.FileSystemBytecodeCache(str(directory))
+
+
+def create_jinja_env(
+    loader: Optional[jinja2.BaseLoader] = None,
+    cache: Optional[jinja2.BytecodeCache] = None,
+) -> jinja2.Environment:
+    """An environment for the project's templates, with compiled code cached on disk,
+    unless a loader (and optionally a bytecode cache) is given
+    """
+    if loader is None:
+        loader = jinja2.FileSystemLoader(searchpath=template_dirs())
+        cache = bytecode_cache()
+    # Each template is loaded at most once per run; compiled code is kept on disk and
+    # reused for as long as the template source is unchanged
     return jinja2.Environment(
-        loader=jinja2.FileSystemLoader(
-            searchpath=[
-                config_dir() / "templates",
-                base_resources_dir() / "templates",
-            ]
-        ),
-        auto_reload=True,
+        loader=loader,
+        bytecode_cache=cache,
+        auto_reload=False,
+        cache_size=-1,
     )
 
 
+def jinja_env() -> jinja2.Environment:
+    registry = active_registry()
+    if registry.environment is None:
+        registry.environment = create_jinja_env()
+    return registry.environment
+
+
 def yml_load(path: Path):
     try:
-        return yaml.safe_load(path.open())
-    except ScannerError as e:
+        with path.open() as f:
+            return yaml.load(f, Loader=YamlLoader)
+    except yaml.YAMLError as e:
         raise ValueError(f"Invalid YAML file: {path.resolve()}") from e
 
 
-def preload_modules():
-    for root in [base_resources_dir(), config_dir()]:
-        for f in (root / "modules").rglob("*.yml"):
-            Module.parse_obj(yml_load(f))  # Side effect: stored in Module.__modules__
+def module_files() -> List[Path]:
+    return [
+        f
+        for root in [base_resources_dir(), config_dir()]
+        for f in (root / "modules").rglob("*.yml")
+    ]
 
 
-def targets_file():
-    targets_raw_path = config_dir() / "targets.yml"
-    targets_template_path = config_dir() / "targets.yml.jinja2"
-    targets_rendered_path = config_dir() / "targets.rendered.yml"
+def template_files() -> List[Path]:
+    return [f for root in template_dirs() for f in root.rglob("*") if f.is_file()]
+
 
-    if targets_raw_path.exists() and targets_template_path.exists():
-        raise RuntimeError(
-            f"Can only have one of {targets_raw_path} or {targets_template_path}"
-        )
+def _parse_module(path: Path) -> Module:
+    data = yml_load(path)
+    try:
+        if not isinstance(data, dict):
+            raise TypeError(f"Expected a mapping, got {type(data).__name__}")
+        return Module(register=False, **data)
+    except (TypeError, ValidationError) as e:
+        raise ValueError(f"Invalid module file: {path.resolve()}") from e
+
+
+def watched_files() -> List[Path]:
+    """Every config file that `synth` reads, excluding caches and rendered files"""
+    cache = config_dir() / ".cache"  # Holds the daemon's socket
+    return [
+        f
+        for f in config_dir().rglob("*")
+        if f.is_file()
+        and cache not in f.parents
+        and not f.name.endswith(".rendered.yml")
+    ]
+
+
+def preload_modules(parse_cache: Optional["ModuleParseCache"] = None):
+    """Loads every module file, storing the results in `Module.__modules__`
+
+    Given a `parse_cache`, files that haven't changed since they were cached skip
+    parsing and validation entirely.
+    """
+    paths = module_files()
+    modules: Dict[Path, Module] = {}
+    if parse_cache is not None:
+        for path in paths:
+            module = parse_cache.get(path)
+            if module is not None:
+                modules[path] = module
+
+    for path in paths:
+        if path not in modules:
+            modules[path] = _parse_module(path)
+            if parse_cache is not None:
+                parse_cache.put(path, modules[path])
+    if parse_cache is not None:
+        parse_cache.retain(paths)
+
+    # Register serially, in discovery order, so duplicate detection is deterministic
+    for path in paths:
+        try:
+            modules[path].register()
+        except RuntimeError as e:
+            raise RuntimeError(f"{e} (in {path.resolve()})") from e
+
+
+def _config_source(stem: str) -> Path:
+    raw_path = config_dir() / f"{stem}.yml"
+    template_path = config_dir() / f"{stem}.yml.jinja2"
+
+    if raw_path.exists() and template_path.exists():
+        raise RuntimeError(f"Can only have one of {raw_path} or {template_path}")
+    elif template_path.exists():
+        return template_path
+    elif raw_path.exists():
+        return raw_path
+    else:
+        raise RuntimeError(f"No {stem}.yml found in {config_dir()}")
 
-    elif targets_template_path.exists():
-        rendered = jinja2.Template(targets_template_path.read_text()).render()
-        targets_rendered_path.write_text(rendered)
-        return targets_rendered_path
 
-    elif targets_raw_path.exists():
-        return targets_raw_path
+def targets_source() -> Path:
+    return _config_source("targets")
 
-    else:
-        raise RuntimeError(f"No targets.yml found in {config_dir()}")
+
+def targets_file():
+    source = targets_source()
+    if source.suffix != ".jinja2":
+        return source
+
+    targets_rendered_path = config_dir() / "targets.rendered.yml"
+    rendered = jinja2.Template(source.read_text()).render()
+    write_if_changed(targets_rendered_path, [rendered])
+    return targets_rendered_path
 
 
 def _local_docker_architecture():
@@ -91,26 +233,23 @@ def _local_docker_architecture():
     return architecture_map.get(arch, arch)
 
 
-def builds_file():
-    builds_raw_path = config_dir() / "builds.yml"
-    builds_template_path = config_dir() / "builds.yml.jinja2"
-    builds_rendered_path = config_dir() / "builds.rendered.yml"
+def builds_template_context() -> Dict[str, str]:
+    return dict(
+        username=getpass.getuser(),
+        local_architecture=_local_docker_architecture(),
+    )
 
-    if builds_raw_path.exists() and builds_template_path.exists():
-        raise RuntimeError(
-            f"Can only have one of {builds_raw_path} or {builds_template_path}"
-        )
 
-    elif builds_template_path.exists():
-        rendered = jinja2.Template(builds_template_path.read_text()).render(
-            username=getpass.getuser(),
-            local_architecture=_local_docker_architecture(),
-        )
-        builds_rendered_path.write_text(rendered)
-        return builds_rendered_path
+def builds_source() -> Path:
+    return _config_source("builds")
 
-    elif builds_raw_path.exists():
-        return builds_raw_path
 
-    else:
-        raise RuntimeError(f"No builds.yml found in {config_dir()}")
+def builds_file():
+    source = builds_source()
+    if source.suffix != ".jinja2":
+        return source
+
+    builds_rendered_path = config_dir() / "builds.rendered.yml"
+    rendered = jinja2.Template(source.read_text()).render(**builds_template_context())
+    write_if_changed(builds_rendered_path, [rendered])
+    return builds_rendered_path
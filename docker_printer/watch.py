@@ -0,0 +1,58 @@
+"""Polling file watcher used by `docker-printer watch`."""
+
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Set, Tuple
+
+Snapshot = Dict[Path, Tuple[int, int]]
+
+
+def snapshot(paths: Iterable[Path]) -> Snapshot:
+    result = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # Deleted between listing and stat
+            continue
+        result[path] = (stat.st_mtime_ns, stat.st_size)
+    return result
+
+
+def changed_paths(before: Snapshot, after: Snapshot) -> Set[Path]:
+    return {
+        path
+        for path in before.keys() | after.keys()
+        if before.get(path) != after.get(path)
+    }
+
+
+def watch_changes(
+    list_paths: Callable[[], Iterable[Path]],
+    interval: float = 0.5,
+    debounce: float = 0.3,
+) -> Iterator[Set[Path]]:
+    """Yields the set of changed paths each time the watched files settle after a change
+
+    A burst of edits (e.g. a save that touches several files, or an editor writing a
+    temporary file and renaming it) is reported once, after no further changes have
+    been seen for `debounce` seconds.
+    """
+    current = snapshot(list_paths())
+    while True:
+        time.sleep(interval)
+        latest = snapshot(list_paths())
+        changed = changed_paths(current, latest)
+        if not changed:
+            continue
+
+        while True:
+            time.sleep(debounce)
+            settled = snapshot(list_paths())
+            more = changed_paths(latest, settled)
+            if not more:
+                break
+            changed |= more
+            latest = settled
+
+        current = latest
+        yield changed
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+from pydantic import ValidationError
+
+from docker_printer.models import BAKE_COMMON_TARGET, BuildCache
+from docker_printer.project import Project
+
+MODULES = [
+    {
+        "name": "a",
+        "priority": 100,
+        "template": {"file": "m.j2", "variables": {"base": "python:3.11"}},
+    },
+    {"name": "b", "priority": 50, "template": {"file": "m.j2"}},
+    {"name": "c", "priority": 50, "template": {"file": "m.j2"}},
+    {"name": "d", "priority": 10, "template": {"file": "m.j2"}},
+]
+TARGETS = [
+    {"name": "app", "modules": ["a", "b"]},
+    {"name": "app-dev", "modules": ["a", "b", "d"]},
+    {"name": "worker", "modules": ["a", "c"]},
+]
+TEMPLATES = {"m.j2": "FROM {{ base }} AS {{ name }}\n"}
+
+
+def bakefile(**config):
+    config = {"name": "default", "image": "my-image", **config}
+    project = Project.from_dicts(MODULES, TARGETS, [config], TEMPLATES)
+    return json.loads(project.render_bakefiles()["default"])
+
+
+def test_shared_arguments_are_inherited():
+    targets = bakefile(build_args={"load": True, "labels": {"for": "${TARGET}"}})[
+        "target"
+    ]
+    assert targets[BAKE_COMMON_TARGET] == {
+        "dockerfile": "Dockerfile.synth",
+        "load": True,
+    }
+    assert targets["worker"] == {
+        "inherits": [BAKE_COMMON_TARGET],
+        "tags": ["my-image:worker"],
+        "target": "worker",
+        "labels": {"for": "worker"},
+    }
+
+
+def test_registry_cache_reads_siblings_nearest_first():
+    targets = bakefile(cache={"registry": "registry.example/cache:${TARGET}"})["target"]
+    assert targets["app-dev"]["cache-from"] == [
+        "type=registry,ref=registry.example/cache:app-dev",
+        "type=registry,ref=registry.example/cache:app",
+        "type=registry,ref=registry.example/cache:worker",
+    ]
+    assert targets["app-dev"]["cache-to"] == [
+        "type=registry,ref=registry.example/cache:app-dev,mode=max"
+    ]
+    assert targets["worker"]["cache-from"] == [
+        "type=registry,ref=registry.example/cache:worker",
+        "type=registry,ref=registry.example/cache:app",
+    ]
+
+
+def test_local_cache_without_target_name_is_read_once():
+    targets = bakefile(cache={"local": "/tmp/cache", "mode": "min"})["target"]
+    assert targets["app-dev"]["cache-from"] == ["type=local,src=/tmp/cache"]
+    assert targets["app-dev"]["cache-to"] == ["type=local,dest=/tmp/cache,mode=min"]
+
+
+def test_cache_merges_with_build_args():
+    targets = bakefile(
+        build_args={"cache-from": "type=gha", "platforms": ["linux/amd64"]},
+        cache={"registry": "cache:${TARGET}"},
+    )["target"]
+    assert "cache-from" not in targets[BAKE_COMMON_TARGET]
+    assert targets[BAKE_COMMON_TARGET]["platforms"] == ["linux/amd64"]
+    assert targets["app"]["cache-from"] == [
+        "type=gha",
+        "type=registry,ref=cache:app",
+        "type=registry,ref=cache:app-dev",
+        "type=registry,ref=cache:worker",
+    ]
+
+
+@pytest.mark.parametrize("backends", [{}, {"registry": "cache", "local": "/tmp"}])
+def test_cache_needs_exactly_one_backend(backends):
+    with pytest.raises(ValidationError):
+        BuildCache(**backends)
@@ -0,0 +1,25 @@
+import pickle
+
+from docker_printer.cache import ModuleParseCache
+from docker_printer.utils import project_cache_dir
+
+
+def test_caches_live_outside_the_project(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    project = tmp_path / "app"
+    cache = project_cache_dir(project)
+    assert project not in cache.parents
+    assert cache.parent == tmp_path / "cache" / "docker-printer"
+    assert cache != project_cache_dir(tmp_path / "other" / "app")
+
+
+def test_unreadable_parse_cache_entries_are_misses(tmp_path):
+    module = tmp_path / "module.yml"
+    module.write_text("name: app\n")
+    stat = module.stat()
+    cache = ModuleParseCache(tmp_path / "modules.pickle")
+    cache.entries[str(module)] = (stat.st_mtime_ns, stat.st_size, b"not a pickle")
+    assert cache.get(module) is None
+
+    (tmp_path / "modules.pickle").write_bytes(pickle.dumps(["not", "a", "cache"]))
+    assert ModuleParseCache.load(tmp_path / "modules.pickle").entries == {}
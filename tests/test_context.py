@@ -0,0 +1,107 @@
+import pytest
+
+from docker_printer.context import (
+    ContextError,
+    ContextSize,
+    _Pattern,
+    context_size,
+    context_sources,
+    dockerignore_lines,
+    is_generated,
+    read_patterns,
+)
+
+
+def test_sources_from_copy_add_and_mounts():
+    dockerfile = """\
+FROM python:3.11 AS app
+COPY requirements.txt setup.py /app/
+COPY --chown=app ["src/", "/app/src/"]
+COPY --from=builder /wheels /wheels
+ADD https://example.com/file.tgz vendor/lib.tgz /opt/
+RUN --mount=type=bind,source=scripts/install.sh,target=/install.sh sh /install.sh
+RUN --mount=type=cache,target=/root/.cache pip install -r requirements.txt
+COPY <<CONFIG /app/config
+setting=1
+CONFIG
+"""
+    assert context_sources(dockerfile) == [
+        "requirements.txt",
+        "scripts/install.sh",
+        "setup.py",
+        "src",
+        "vendor/lib.tgz",
+    ]
+
+
+@pytest.mark.parametrize(
+    "instruction",
+    [
+        "COPY . /app",
+        "COPY ./ /app",
+        "COPY $SRC /app",
+        "ADD ../shared /shared",
+        "RUN --mount=type=bind,target=/src make",
+    ],
+)
+def test_sources_that_cannot_be_narrowed(instruction):
+    with pytest.raises(ContextError):
+        context_sources(f"FROM scratch\n{instruction}\n")
+
+
+@pytest.mark.parametrize(
+    "pattern, path, matches",
+    [
+        ("*.pyc", "main.pyc", True),
+        ("*.pyc", "app/main.pyc", False),
+        ("**/*.pyc", "app/sub/main.pyc", True),
+        ("**/*.pyc", "main.pyc", True),
+        ("app", "app/main.py", True),
+        ("/app/", "app/main.py", True),
+        ("dat?", "data", True),
+        ("dat?", "dat", False),
+        ("[a-c]*", "build", True),
+        ("[!a-c]*", "build", False),
+        ("docs/**", "docs/a/b.md", True),
+        ("\\*.txt", "*.txt", True),
+        ("\\*.txt", "a.txt", False),
+    ],
+)
+def test_patterns_match_like_docker(pattern, path, matches):
+    assert _Pattern.parse(pattern).matches(path.split("/")) is matches
+
+
+def test_context_size_applies_exceptions_in_order(tmp_path):
+    for name, content in [
+        ("app/main.py", "12345"),
+        ("app/main.pyc", "1"),
+        ("node_modules/pkg/index.js", "123"),
+        ("node_modules/keep/index.js", "12"),
+        ("README.md", "1234"),
+    ]:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    assert context_size(tmp_path) == ContextSize(5, 15)
+    patterns = ["**/*.pyc", "node_modules", "!node_modules/keep"]
+    assert context_size(tmp_path, patterns) == ContextSize(3, 11)
+    only_app = ["*", "!app", "app/*.pyc"]
+    assert context_size(tmp_path, only_app) == ContextSize(1, 5)
+
+
+def test_generated_ignore_files(tmp_path):
+    path = tmp_path / "Dockerfile.synth.dockerignore"
+    path.write_text("".join(dockerignore_lines("Dockerfile.synth", ["app"], ["*.pyc"])))
+    assert is_generated(path)
+    assert read_patterns(path) == ["*", "!app", "*.pyc"]
+
+    (tmp_path / ".dockerignore").write_text("# Mine\nnode_modules\n\n")
+    assert not is_generated(tmp_path / ".dockerignore")
+    assert read_patterns(tmp_path / ".dockerignore") == ["node_modules"]
+    assert read_patterns(tmp_path / "missing") == []
+
+
+def test_context_size_formatting():
+    assert str(ContextSize(1, 999)) == "999 B in 1 file"
+    assert str(ContextSize(2, 1500)) == "1.5 kB in 2 files"
@@ -0,0 +1,79 @@
+import pytest
+
+from docker_printer.graph import DependencyError, DependencyGraph, iter_bits
+from docker_printer.project import Project
+
+
+def test_iter_bits():
+    assert list(iter_bits(0)) == []
+    assert list(iter_bits(0b101001)) == [0, 3, 5]
+    assert list(iter_bits(1 << 5000 | 1)) == [0, 5000]
+
+
+def test_closures_include_everything_reachable():
+    edges = {"app": ["deps", "tools"], "deps": ["base"], "tools": ["base"], "base": []}
+    graph = DependencyGraph(edges).resolve(["app"])
+    assert sorted(graph.decode(graph.closures["app"])) == [
+        "app",
+        "base",
+        "deps",
+        "tools",
+    ]
+    assert graph.decode(graph.closures["deps"]) == ["deps", "base"]
+    assert graph.order.index("base") < graph.order.index("deps")
+    assert graph.order[-1] == "app"
+    assert not graph.cycles and not graph.missing
+
+
+def test_closures_decode_in_the_given_order():
+    edges = {"c": ["a"], "a": ["b"], "b": []}
+    graph = DependencyGraph(edges, ordering=["a", "b", "c"]).resolve(["c"])
+    assert graph.decode(graph.closures["c"]) == ["a", "b", "c"]
+
+
+def test_only_reachable_nodes_are_resolved():
+    edges = {"a": ["b"], "b": [], "c": ["a"]}
+    graph = DependencyGraph(edges).resolve(["a"])
+    assert set(graph.closures) == {"a", "b"}
+
+
+def test_cycles_and_missing_references_are_all_reported():
+    edges = {"a": ["b"], "b": ["a", "gone"], "c": ["c"], "d": ["a", "c"]}
+    graph = DependencyGraph(edges).resolve(["d"])
+    assert sorted(graph.cycles) == [["a", "b"], ["c"]]
+    assert graph.missing == [("b", "gone")]
+    # Members of a cycle share one closure
+    assert graph.closures["a"] == graph.closures["b"]
+    assert sorted(graph.decode(graph.closures["d"])) == ["a", "b", "c", "d"]
+
+
+def test_deep_chains_do_not_recurse():
+    edges = {str(i): [str(i + 1)] for i in range(20_000)}
+    edges["20000"] = []
+    graph = DependencyGraph(edges).resolve(["0"])
+    assert len(graph.decode(graph.closures["0"])) == 20_001
+
+
+def test_resolving_targets_reports_every_problem():
+    template = {"file": "m.j2", "variables": {"base": "python:3.11"}}
+    project = Project.from_dicts(
+        modules=[
+            {"name": "a", "depends_on": ["b"], "template": template},
+            {"name": "b", "depends_on": ["a"], "template": template},
+            {"name": "c", "depends_on": ["missing"], "template": template},
+        ],
+        targets=[
+            {"name": "t1", "modules": ["a", "c"]},
+            {"name": "t2", "modules": ["nope"], "extends": ["t3"]},
+            {"name": "t3", "modules": [], "extends": ["t2"]},
+        ],
+        templates={"m.j2": "FROM {{ base }} AS {{ name }}\n"},
+    )
+    with project.activate(), pytest.raises(DependencyError) as error:
+        project.targets.plan_stages(project.targets.select())
+    assert sorted(error.value.problems) == [
+        "Module 'c' depends on unknown module 'missing'",
+        "Modules depend on each other in a cycle: a, b",
+        "Target 't2' uses unknown module 'nope'",
+        "Targets extend each other in a cycle: t2, t3",
+    ]
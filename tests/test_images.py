@@ -0,0 +1,88 @@
+from docker_printer.images import DirectoryImageStore
+from docker_printer.project import Project
+from docker_printer.scheduler import (
+    BuildScheduler,
+    Executor,
+    mark_up_to_date,
+    plan_jobs,
+)
+
+MODULES = [
+    {
+        "name": "a",
+        "priority": 100,
+        "template": {"file": "m.j2", "variables": {"base": "python:3.11", "cmd": "a"}},
+    },
+    {
+        "name": "b",
+        "priority": 50,
+        "template": {"file": "m.j2", "variables": {"cmd": "b"}},
+    },
+    {
+        "name": "c",
+        "priority": 50,
+        "template": {"file": "m.j2", "variables": {"cmd": "c"}},
+    },
+]
+TEMPLATES = {"m.j2": "FROM {{ base }} AS {{ name }}\nRUN echo {{ cmd }}\n"}
+TARGETS = [{"name": "t1", "modules": ["a", "b"]}, {"name": "t3", "modules": ["a", "c"]}]
+
+
+class StubExecutor(Executor):
+    def __init__(self):
+        self.started = []
+
+    def run(self, job, log):
+        self.started.append(job.name)
+        return 0
+
+
+def fingerprints(targets):
+    project = Project.from_dicts(MODULES, targets, templates=TEMPLATES)
+    result = {}
+    with project.activate():
+        "".join(
+            project.targets.iter_dockerfile(
+                project.environment, verbose=False, fingerprints=result
+            )
+        )
+    return project, result
+
+
+def build(targets, store):
+    """Builds every target the way `build --jobs` does, returning the jobs that ran"""
+    project, fingerprint_of = fingerprints(targets)
+    with project.activate():
+        names = [target.name for target in project.targets.select()]
+        jobs = plan_jobs(project.targets.plan_stages(project.targets.select()), names)
+    mark_up_to_date(jobs, lambda job: store.contains(fingerprint_of[job.name]))
+    executor = StubExecutor()
+    assert BuildScheduler(jobs, executor, echo=lambda line: None).run()
+    for job in jobs:
+        if job.target is not None and job.status == "succeeded":
+            store.add(fingerprint_of[job.name], job.name)
+    return sorted(executor.started)
+
+
+def test_fingerprints_ignore_stage_names():
+    _, before = fingerprints(TARGETS)
+    _, after = fingerprints(TARGETS + [{"name": "t4", "modules": ["a"]}])
+    assert before["t1"] == after["t1"]
+    assert before["t3"] == after["t3"]
+
+
+def test_fingerprints_follow_the_base():
+    _, before = fingerprints(TARGETS)
+    MODULES[0]["template"]["variables"]["base"] = "python:3.12"
+    try:
+        _, after = fingerprints(TARGETS)
+    finally:
+        MODULES[0]["template"]["variables"]["base"] = "python:3.11"
+    assert before["t1"] != after["t1"]
+
+
+def test_built_targets_are_skipped(tmp_path):
+    store = DirectoryImageStore(tmp_path / "images")
+    assert build(TARGETS, store) == ["a", "t1", "t3"]
+    assert build(TARGETS, store) == []
+    assert build(TARGETS + [{"name": "t4", "modules": ["a"]}], store) == ["t4"]
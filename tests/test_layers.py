@@ -0,0 +1,61 @@
+from docker_printer.project import Project
+
+TEMPLATES = {
+    "env.j2": "FROM {{ base }} AS {{ name }}\nENV X=1\n",
+    "shell.j2": 'FROM {{ base }} AS {{ name }}\nSHELL ["/bin/bash", "-c"]\n',
+    "run.j2": "FROM {{ base }} AS {{ name }}\nRUN echo a\nRUN echo b\n",
+}
+
+
+def optimize(modules, targets):
+    project = Project.from_dicts(modules, targets, templates=TEMPLATES)
+    savings = {}
+    with project.activate():
+        dockerfile = "".join(
+            project.targets.iter_dockerfile(
+                project.environment, verbose=False, layer_savings=savings
+            )
+        )
+    return dockerfile, savings
+
+
+def module(name, priority, file, base=None):
+    variables = {} if base is None else {"base": base}
+    return {
+        "name": name,
+        "priority": priority,
+        "template": {"file": file, "variables": variables},
+    }
+
+
+def test_settings_from_an_unrelated_image_are_kept():
+    dockerfile, savings = optimize(
+        [
+            module("a", 100, "env.j2", base="python:3.11"),
+            module("b", 50, "env.j2", base="ubuntu:22.04"),
+        ],
+        [{"name": "t", "modules": ["a", "b"]}],
+    )
+    assert dockerfile.count("ENV X=1") == 2
+    assert savings["t"].base is None
+
+
+def test_runs_stay_apart_under_an_inherited_shell():
+    dockerfile, savings = optimize(
+        [
+            module("s", 100, "shell.j2", base="python:3.11"),
+            module("r", 50, "run.j2"),
+        ],
+        [{"name": "u", "modules": ["s", "r"]}],
+    )
+    assert "RUN echo a\nRUN echo b\n" in dockerfile
+    assert savings["u"].layers == 0
+
+
+def test_runs_merge_otherwise():
+    dockerfile, savings = optimize(
+        [module("r", 50, "run.j2", base="python:3.11")],
+        [{"name": "u", "modules": ["r"]}],
+    )
+    assert "RUN echo a && \\\n    echo b\n" in dockerfile
+    assert savings["u"].layers == 1
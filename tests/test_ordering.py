@@ -0,0 +1,64 @@
+from docker_printer.models import Module
+from docker_printer.ordering import (
+    EVERYTHING,
+    hit_rate,
+    suggest_order,
+    suggest_priorities,
+)
+
+
+def module(name, priority=0, depends_on=(), base=None):
+    variables = {} if base is None else {"base": base}
+    return Module(
+        register=False,
+        name=name,
+        priority=priority,
+        depends_on=list(depends_on),
+        template={"file": "m.j2", "variables": variables},
+    )
+
+
+def names(modules):
+    return [m.name for m in modules]
+
+
+def test_volatile_modules_go_last():
+    modules = [module("code", 50), module("deps", 40), module("tools", 30)]
+    order = suggest_order(modules, {"code": 9, "deps": 2})
+    assert names(order) == ["tools", "deps", "code"]
+
+
+def test_dependencies_and_fixed_bases_come_first():
+    modules = [
+        module("app", 10, depends_on=["deps"]),
+        module("deps", 5),
+        module("base", 0, base="python:3.11"),
+    ]
+    order = suggest_order(modules, {"deps": 5, "base": 9})
+    assert names(order) == ["base", "deps", "app"]
+
+
+def test_ties_keep_the_current_order():
+    modules = [module("b", 10), module("a", 10), module("c", 20)]
+    assert names(suggest_order(modules, {})) == ["c", "a", "b"]
+
+
+def test_priorities_keep_those_already_in_order():
+    modules = {m.name: m for m in [module("a", 100), module("b", 50), module("c", 70)]}
+    order = [modules["a"], modules["b"], modules["c"]]
+    assert suggest_priorities(order) == {"a": 100, "b": 50, "c": 49}
+
+
+def test_priorities_break_name_ties():
+    a, b = module("a", 10), module("b", 10)
+    assert suggest_priorities([a, b]) == {"a": 10, "b": 10}
+    assert suggest_priorities([b, a]) == {"b": 10, "a": 9}
+
+
+def test_hit_rate_counts_shared_prefixes_once():
+    chains = [["base", "app"], ["base", "worker"]]
+    # Stages: base, base+app, base+worker
+    assert hit_rate(chains, [frozenset(["app"])]) == 1 - 1 / 3
+    assert hit_rate(chains, [frozenset(["base"])]) == 0
+    assert hit_rate(chains, [EVERYTHING, frozenset(["worker"])]) == 1 - 4 / 6
+    assert hit_rate(chains, []) == 1.0
@@ -0,0 +1,36 @@
+import random
+import re
+
+import pytest
+
+from docker_printer.output import collapse_blank_lines
+
+
+def expected(pieces):
+    return re.sub(r"\n{3,}", "\n\n", "".join(pieces))
+
+
+@pytest.mark.parametrize(
+    "pieces",
+    [
+        [],
+        [""],
+        ["FROM a\n\n\n\nRUN b\n"],
+        ["\n\n\n", "FROM a"],
+        ["FROM a\n", "\n", "\n", "\n", "RUN b"],
+        ["FROM a\n\n", "\n\nRUN b\n\n", "", "\n"],
+        ["a\n", "", "\n", "", "\nb"],
+        ["a\n\n", "b\n\n\n"],
+    ],
+)
+def test_matches_collapsing_the_joined_text(pieces):
+    assert "".join(collapse_blank_lines(pieces)) == expected(pieces)
+
+
+def test_matches_for_any_split():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(rng.choice(["\n", "\n", "a", "bc"]) for _ in range(30))
+        cuts = sorted(rng.sample(range(len(text) + 1), rng.randint(0, 8)))
+        pieces = [text[i:j] for i, j in zip([0, *cuts], [*cuts, len(text)])]
+        assert "".join(collapse_blank_lines(pieces)) == expected(pieces)
@@ -0,0 +1,79 @@
+import threading
+
+from docker_printer.scheduler import BuildJob, BuildScheduler, Executor
+
+
+class FakeExecutor(Executor):
+    """Records the jobs it runs instead of building them, failing the named ones"""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.started = []
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def run(self, job, log):
+        with self._lock:
+            self.started.append(job.name)
+        log(f"building {job.name}")
+        return 1 if job.name in self.fail else 0
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def make_jobs():
+    base = BuildJob("base", None, [])
+    app = BuildJob("app", "app", [base])
+    worker = BuildJob("worker", "worker", [base])
+    app_dev = BuildJob("app-dev", "app-dev", [app])
+    return [base, app, worker, app_dev]
+
+
+def test_runs_dependencies_first():
+    jobs = make_jobs()
+    executor = FakeExecutor()
+    scheduler = BuildScheduler(jobs, executor, max_workers=2, echo=lambda line: None)
+
+    assert scheduler.run()
+    assert all(job.status == "succeeded" for job in jobs)
+    started = executor.started
+    assert started[0] == "base"
+    assert started.index("app") < started.index("app-dev")
+    assert sorted(started) == sorted(job.name for job in jobs)
+
+
+def test_stage_jobs_borrow_a_target():
+    base, app, _, _ = make_jobs()
+    BuildScheduler([base, app], FakeExecutor())
+    assert base.representative == "app"
+
+
+def test_failure_skips_dependents():
+    jobs = make_jobs()
+    executor = FakeExecutor(fail={"app"})
+    scheduler = BuildScheduler(jobs, executor, max_workers=1, echo=lambda line: None)
+
+    assert not scheduler.run()
+    statuses = {job.name: job.status for job in jobs}
+    assert statuses["base"] == "succeeded"
+    assert statuses["app"] == "failed"
+    assert statuses["app-dev"] == "skipped"
+    assert "app-dev" not in executor.started
+    assert executor.cancelled
+
+
+def test_output_is_prefixed_per_job():
+    lines = []
+    BuildScheduler(make_jobs()[:2], FakeExecutor(), echo=lines.append).run()
+    assert "[base] building base" in lines
+    assert "[app ] building app" in lines
+
+
+def test_summary_lists_every_job():
+    jobs = make_jobs()
+    scheduler = BuildScheduler(jobs, FakeExecutor(), echo=lambda line: None)
+    scheduler.run()
+    summary = scheduler.summary().splitlines()
+    assert len(summary) == len(jobs)
+    assert "stage " in summary[0] and summary[0].endswith("base")
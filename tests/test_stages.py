@@ -0,0 +1,148 @@
+import pytest
+
+from docker_printer.models import CommonListTree, Stage
+from docker_printer.project import Project
+
+
+def module(name, priority, cmd, base=None, depends_on=()):
+    variables = {"cmd": cmd}
+    if base is not None:
+        variables["base"] = base
+    return {
+        "name": name,
+        "priority": priority,
+        "depends_on": list(depends_on),
+        "template": {"file": "m.j2", "variables": variables},
+    }
+
+
+MODULES = [
+    module("base", 100, "setup", base="python:3.11"),
+    module("deps", 50, "pip install", depends_on=["base"]),
+    module("app", 10, "make app", depends_on=["deps"]),
+    module("worker", 10, "make worker", depends_on=["deps"]),
+    # Renders just like `base`, so merging can replace it
+    module("node", 100, "setup", base="python:3.11"),
+    module("lint", 10, "lint"),
+]
+TARGETS = [
+    {"name": "app", "modules": ["app"]},
+    {"name": "app-plain", "modules": ["app"]},
+    {"name": "worker", "modules": ["worker"]},
+    {"name": "frontend", "modules": ["node", "lint"]},
+]
+TEMPLATES = {"m.j2": "FROM {{ base }} AS {{ name }}\nRUN {{ cmd }}\n"}
+
+
+@pytest.fixture
+def project():
+    return Project.from_dicts(MODULES, TARGETS, templates=TEMPLATES)
+
+
+def plan(project, **options):
+    with project.activate():
+        return project.targets.plan_stages(project.targets.select(), **options)
+
+
+def test_dockerfile(project):
+    assert project.render_dockerfile() == (
+        "# syntax=docker/dockerfile:1\n\n"
+        "FROM python:3.11 AS base-app-app-plain-worker\nRUN setup\n\n"
+        "FROM base-app-app-plain-worker AS deps-app-app-plain-worker\n"
+        "RUN pip install\n\n"
+        "FROM deps-app-app-plain-worker AS app-app-app-plain\nRUN make app\n\n"
+        "FROM deps-app-app-plain-worker AS worker\nRUN make worker\n\n"
+        "FROM python:3.11 AS node-frontend\nRUN setup\n\n"
+        "FROM node-frontend AS frontend\nRUN lint\n\n"
+        "FROM app-app-app-plain AS app\n\n"
+        "FROM app-app-app-plain AS app-plain\n\n"
+    )
+
+
+def test_pruned_dockerfile_names_stages_for_its_targets(project):
+    assert project.render_dockerfile(["worker"]) == (
+        "# syntax=docker/dockerfile:1\n\n"
+        "FROM python:3.11 AS base\nRUN setup\n\n"
+        "FROM base AS deps\nRUN pip install\n\n"
+        "FROM deps AS worker\nRUN make worker\n"
+    )
+
+
+def test_merged_dockerfile(project):
+    assert project.render_dockerfile(merge_duplicates=True) == (
+        "# syntax=docker/dockerfile:1\n\n"
+        "FROM python:3.11 AS base\nRUN setup\n\n"
+        "FROM base AS deps-app-app-plain-worker\nRUN pip install\n\n"
+        "FROM deps-app-app-plain-worker AS app-app-app-plain\nRUN make app\n\n"
+        "FROM deps-app-app-plain-worker AS worker\nRUN make worker\n\n"
+        "FROM base AS frontend\nRUN lint\n\n"
+        "FROM app-app-app-plain AS app\n\n"
+        "FROM app-app-app-plain AS app-plain\n\n"
+    )
+
+
+def test_merging_records_replaced_stages(project):
+    merged = plan(project, merge_duplicates=True)
+    assert [(stage.name, name) for stage, name in merged.merged] == [
+        ("node-frontend", "base")
+    ]
+    assert merged.last_stage_per_target["frontend"] == "frontend"
+
+
+def test_stages_with_different_bases_are_not_merged():
+    modules = [
+        module("py", 100, "setup", base="python:3.11"),
+        module("alpine", 100, "setup", base="alpine:3"),
+        module("tool", 10, "install"),
+    ]
+    targets = [
+        {"name": "a", "modules": ["py", "tool"]},
+        {"name": "b", "modules": ["alpine", "tool"]},
+    ]
+    project = Project.from_dicts(modules, targets, templates=TEMPLATES)
+    merged = plan(project, merge_duplicates=True)
+    assert merged.merged == []
+    assert [stage.name for stage in merged.stages] == ["py-a", "a", "alpine-b", "b"]
+
+
+def test_folding_names_a_stage_after_one_target(project):
+    folded = plan(project, fold_targets=True)
+    assert folded.folded == ["app"]
+    assert folded.stages[2] == Stage(
+        folded.stages[2].module, "deps-app-app-plain-worker", "app"
+    )
+    # The second target ending there keeps its bare stage, now built on the first
+    assert folded.stages[-1] == Stage(None, "app", "app-plain")
+    assert folded.last_stage_per_target["app-plain"] == "app"
+    assert all(stage.module is not None for stage in folded.stages[:-1])
+
+
+def test_folding_leaves_plans_without_bare_stages_alone():
+    targets = [{"name": "worker", "modules": ["worker"]}]
+    project = Project.from_dicts(MODULES, targets, templates=TEMPLATES)
+    assert plan(project, fold_targets=True).folded == []
+
+
+def test_tree_shares_common_prefixes():
+    tree = CommonListTree()
+    tree.merge_list(["a", "b", "c"], "t1")
+    tree.merge_list(["a", "b"], "t2")
+    tree.merge_list(["a", "d"], "t3")
+    visited = []
+    tree.visit(lambda value, node, parent: visited.append((value, node.labels)))
+    assert visited == [
+        ("a", {"t1", "t2", "t3"}),
+        ("b", {"t1", "t2"}),
+        ("c", {"t1"}),
+        ("d", {"t3"}),
+    ]
+    b = tree.root.children["a"].children["b"]
+    assert b.terminal_labels == {"t2"}
+
+
+def test_tree_handles_deep_chains():
+    tree = CommonListTree()
+    tree.merge_list(range(20_000), "deep")
+    count = []
+    tree.visit(lambda value, node, parent: count.append(value))
+    assert len(count) == 20_000